@@ -19,7 +19,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import math
 from cloudsim import dataset
 from jointfunc_vcg.data.gen import generate_init_data, generate_data
-from jointfunc_vcg.data import gen, plot, produce
+from jointfunc_vcg.data import azure_trace, gen, plot, produce, lazy, shards, stages, tiled, vals_cache, vals_shm
 
 
 r"""
@@ -54,8 +54,7 @@ Thus, each valuation matrix will be of size $256 \times 256$.
 
 
 def generate(sd):
-    generate_init_data(sd)
-    generate_data(sd)
+    stages.generate(sd)
 
 
 folder_format = "{ndim}d-{n}p"
@@ -0,0 +1,224 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import contextlib
+import numpy as np
+
+from cloudsim import azure
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows: concurrent processes may parse the trace at the same time
+    fcntl = None
+
+"""
+A compact, columnar, copy of the columns of the Azure trace that are used to generate the datasets.
+The trace is parsed once by `preprocess()`, which writes each column to its own `.npy` file,
+along with a precomputed index of the eligible VMs. `load()` memory-maps these files.
+The copy is keyed by its parameters and by the size and modification time of the trace's source files,
+so a changed trace is parsed again. The source files are `source_paths`, or the `JOINTFUNC_VCG_AZURE_TRACE_PATH`
+paths. Otherwise, they are the files that were opened while the trace was parsed, which are recorded in the
+cache directory (`DETECTED_SOURCES_FILE`). If no such file was opened, the copy is keyed by its content, so the
+trace is parsed once per process.
+Concurrent processes wait for the one that parses the trace, and the copy is published atomically.
+"""
+
+DEFAULT_CACHE_DIR = os.environ.get('JOINTFUNC_VCG_AZURE_CACHE_DIR',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'jointfunc-vcg', 'azure'))
+DEFAULT_SOURCE_PATHS = tuple(p for p in os.environ.get('JOINTFUNC_VCG_AZURE_TRACE_PATH', '').split(os.pathsep) if p)
+DETECTED_SOURCES_FILE = 'detected-sources.json'
+TRACE_VERSION = 1
+MIN_RUN_TIME = 60
+
+COLUMNS = 'run-time', 'cores', 'eligible'
+
+loaded_trace = {}
+# The copies of the traces whose source files are not known, per cache directory
+unknown_source_trace_dirs = {}
+
+# The lists of the files that are opened while they are recorded (see `read_trace()`)
+recorded_opens = []
+is_audit_hook_added = False
+
+
+def record_open(event, args):
+    if event == 'open' and recorded_opens and isinstance(args[0], (str, bytes, os.PathLike)):
+        for opened in recorded_opens:
+            opened.append(os.fsdecode(args[0]))
+
+
+def is_source_path(path):
+    """ Returns True if an opened file may be a source of the trace, and not, e.g., a module that was imported """
+    if not os.path.isfile(path) or path.endswith(('.py', '.pyc', '.so', '.pyd')):
+        return False
+    path = os.path.realpath(path)
+    prefixes = {os.path.realpath(p) for p in (sys.prefix, sys.base_prefix, sys.exec_prefix)}
+    return not any(path.startswith(p + os.sep) for p in prefixes)
+
+
+def read_trace():
+    """ Parses the full Azure trace. Returns it, and the paths of the files that were opened to parse it. """
+    global is_audit_hook_added
+    if not is_audit_hook_added:
+        # Audit hooks cannot be removed, so it is added once per process, and only records within `read_trace()`
+        sys.addaudithook(record_open)
+        is_audit_hook_added = True
+
+    opened = []
+    recorded_opens.append(opened)
+    try:
+        full_azure_data = azure.read_azure_data()
+    finally:
+        recorded_opens.remove(opened)
+    return full_azure_data, tuple(sorted({os.path.abspath(p) for p in opened if is_source_path(p)}))
+
+
+def get_cache_key(source_paths, content_digest=None):
+    """
+    Returns a key of the preprocessing parameters and of the source files' size and modification time,
+    or of the trace's content digest if the source files are not known
+    """
+    sources = []
+    for path in source_paths:
+        st = os.stat(path)
+        sources.append((os.path.abspath(path), st.st_size, st.st_mtime_ns))
+    h = hashlib.sha1(json.dumps({
+        'version': TRACE_VERSION,
+        'min-run-time': MIN_RUN_TIME,
+        'columns': COLUMNS,
+        'sources': sources,
+        'content': content_digest,
+    }, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def get_configured_source_paths(source_paths=None):
+    if source_paths is not None:
+        return tuple(source_paths)
+    return DEFAULT_SOURCE_PATHS or None
+
+
+def get_source_paths(cache_dir, source_paths=None):
+    """ Returns the configured source files of the trace, or the ones that were detected when it was parsed """
+    if source_paths is not None:
+        return source_paths
+    try:
+        with open(os.path.join(cache_dir, DETECTED_SOURCES_FILE)) as f:
+            return tuple(json.load(f))
+    except (FileNotFoundError, ValueError):
+        return ()
+
+
+def get_trace_dir(cache_dir, source_paths):
+    """ Returns the directory of the trace's copy, or None if its source files are not known (or are gone) """
+    if not source_paths:
+        return None
+    try:
+        return os.path.join(cache_dir, get_cache_key(source_paths))
+    except FileNotFoundError:
+        return None
+
+
+def get_column_path(trace_dir, column):
+    return os.path.join(trace_dir, f'{column}.npy')
+
+
+@contextlib.contextmanager
+def locked(path):
+    with open(path, 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def preprocess(cache_dir, source_paths=None):
+    """
+    Parses the full Azure trace, and writes the needed columns and the eligible VMs index into a temporary
+    directory, which is then renamed to the trace's directory. Returns the trace's directory.
+    If `source_paths` is not given, the files that were opened to parse the trace are recorded as its sources.
+    """
+    full_azure_data, opened = read_trace()
+    run_time = np.array(full_azure_data['timestamp vm deleted'] - full_azure_data['timestamp vm created'])
+    cores = np.array(full_azure_data['vm virtual core count'])
+
+    if source_paths is None:
+        source_paths = opened
+        write_detected_sources(cache_dir, opened)
+    if source_paths:
+        trace_dir = os.path.join(cache_dir, get_cache_key(source_paths))
+    else:
+        h = hashlib.sha1()
+        for a in (run_time, cores):
+            h.update(np.ascontiguousarray(a).tobytes())
+        trace_dir = os.path.join(cache_dir, get_cache_key((), h.hexdigest()))
+        unknown_source_trace_dirs[cache_dir] = trace_dir
+    if os.path.isdir(trace_dir):
+        return trace_dir
+
+    tmp_dir = tempfile.mkdtemp(prefix='tmp-', dir=cache_dir)
+    try:
+        np.save(get_column_path(tmp_dir, 'run-time'), run_time)
+        np.save(get_column_path(tmp_dir, 'cores'), cores)
+        np.save(get_column_path(tmp_dir, 'eligible'), np.where(run_time > MIN_RUN_TIME)[0])
+        try:
+            os.rename(tmp_dir, trace_dir)
+        except OSError:
+            # Published by another process (without a lock)
+            if not os.path.isdir(trace_dir):
+                raise
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+    return trace_dir
+
+
+def write_detected_sources(cache_dir, source_paths):
+    fd, tmp_path = tempfile.mkstemp(prefix='tmp-', suffix='.json', dir=cache_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(list(source_paths), f)
+    os.replace(tmp_path, os.path.join(cache_dir, DETECTED_SOURCES_FILE))
+
+
+def load(cache_dir=None, source_paths=None):
+    """ Returns the memory mapped columns of the trace (see `COLUMNS`), and preprocesses it if needed """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    source_paths = get_configured_source_paths(source_paths)
+    trace_dir = get_trace_dir(cache_dir, get_source_paths(cache_dir, source_paths))
+    if trace_dir is None:
+        trace_dir = unknown_source_trace_dirs.get(cache_dir, None)
+    if trace_dir in loaded_trace:
+        return loaded_trace[trace_dir]
+
+    if trace_dir is None or not os.path.isdir(trace_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        with locked(os.path.join(cache_dir, 'trace.lock')):
+            # Another process may have preprocessed it while this one waited
+            trace_dir = get_trace_dir(cache_dir, get_source_paths(cache_dir, source_paths))
+            if trace_dir is None or not os.path.isdir(trace_dir):
+                trace_dir = preprocess(cache_dir, source_paths)
+    ret = {c: np.load(get_column_path(trace_dir, c), mmap_mode='r') for c in COLUMNS}
+    loaded_trace[trace_dir] = ret
+    return ret
@@ -16,25 +16,37 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import os
 import time
+import functools
+import contextlib
+import concurrent.futures
 import numpy as np
 
 import vecfunc
-from cloudsim import stats, azure
+from cloudsim import stats
 from cloudsim.sim_data import SimulationData
+from jointfunc_vcg.data import azure_trace, produce, shards
 
 
-def generate_init_data(sd: SimulationData):
+# The per-player stages that draw from their own sub-seed (see `get_player_seeds()`)
+STAGE_INIT_VALUATION = 1
+STAGE_REFINE_VALUATION = 2
+STAGE_RESOURCE_DEPENDENCY = 3
+
+
+def generate_init_data(sd: SimulationData, workers=1):
     sd.init_seed()
     sd.log("Generating initial data (seed: %d)..." % sd.seed)
 
     generate_distributions(sd)
-    generate_init_valuation(sd)
+    if shards.get_shard_size(sd) is None:
+        generate_init_valuation(sd, workers=workers)
 
     return sd
 
 
-def generate_data(sd: SimulationData):
+def generate_data(sd: SimulationData, workers=1):
     if 'generate-time' in sd.meta:
         sd.log("Data already generated.")
         return
@@ -42,7 +54,10 @@ def generate_data(sd: SimulationData):
     sd.log("Generating data...")
 
     t1 = time.time()
-    generate_valuation(sd)
+    if shards.get_shard_size(sd) is None:
+        generate_valuation(sd, workers=workers)
+    else:
+        generate_valuation_sharded(sd, workers=workers)
     generate_time = time.time() - t1
 
     sd.meta['generate-time'] = generate_time
@@ -70,21 +85,19 @@ def generate_distributions(sd: SimulationData):
     local_maximum_limit = sd.meta['valuation'].setdefault('local-maximum-limit', None)
     if local_maximum_limit is not None and local_maximum_limit > 0:
         val_local_maximum = np.clip(val_freq-3, 0, local_maximum_limit)
-        val_local_maximum = np.array([np.random.randint(0, f + 1) for f in val_local_maximum.flatten()],
-                                     dtype=int).reshape(n, ndim)
+        # Draws the same values as drawing each element separately
+        val_local_maximum = np.random.randint(0, val_local_maximum + 1).astype(int)
     else:
         val_local_maximum = np.zeros_like(val_freq, dtype=int)
     dist_data['val-local-maximum'] = val_local_maximum
 
     # Collect Azure Data
     sd.log(", collect azure data", end="")
-    full_azure_data = azure.read_azure_data()
-    run_time = np.array(full_azure_data['timestamp vm deleted'] - full_azure_data['timestamp vm created'])
-    relevant_players = np.where(run_time > 60)[0]
+    azure_data = azure_trace.load()
+    relevant_players = np.asarray(azure_data['eligible'])
     azure_players = np.random.choice(relevant_players, n, replace=False)
     dist_data['azure-players'] = azure_players
-    all_cores = full_azure_data['vm virtual core count']
-    cores = np.array(all_cores)[azure_players]
+    cores = np.asarray(azure_data['cores'][azure_players])
 
     # Wealth: Indicate the expected income of the player
     sd.log(", wealth.")
@@ -99,29 +112,150 @@ def generate_distributions(sd: SimulationData):
     dist_data['wealth'] = stats.scipy_dist_ppf(wealth_uniform, sd.meta['valuation']['wealth-dist'])
 
 
-def generate_init_valuation(sd: SimulationData):
+def get_player_seeds(sd: SimulationData, stage):
+    """ Returns a seed for each player in a stage, derived from the dataset item's seed """
+    return np.random.SeedSequence((sd.seed, stage)).generate_state(sd.n)
+
+
+def get_stage_seed(sd: SimulationData, stage):
+    """ Returns a seed for a stage that is drawn for all the players at once """
+    return np.random.SeedSequence((sd.seed, stage, sd.n)).generate_state(1)[0]
+
+
+def get_players_executor(workers=1):
+    """
+    Returns a process pool of `workers` processes (None: one per CPU), or a null context for one worker (default).
+    The pool is opt-in: the dataset items are usually generated in parallel already (e.g., `parallel_create_data()`),
+    and their (daemonic) pool processes cannot create a pool of their own.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        return contextlib.nullcontext()
+    return concurrent.futures.ProcessPoolExecutor(workers)
+
+
+def map_players(func, seeds, *args, workers=1, executor=None):
+    """
+    Calls `func(seed, *args)` for each player over the `executor`, or over a new process pool of `workers`
+    processes (see `get_players_executor()`; by default, serially). Each player draws only from its own seed,
+    so the results are identical regardless of the number of workers.
+    """
+    if executor is not None:
+        chunksize = max(1, len(seeds) // (4 * (os.cpu_count() or 1)))
+        return list(executor.map(func, seeds, *args, chunksize=chunksize))
+    if len(seeds) > 1:
+        with get_players_executor(workers) as executor:
+            if executor is not None:
+                return map_players(func, seeds, *args, executor=executor)
+    return list(map(func, seeds, *args))
+
+
+@contextlib.contextmanager
+def player_seed(seed):
+    """ Seeds numpy's global random state for one player, and restores it afterwards """
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
+
+
+def sample_init_valuation(seed, val_freq, val_local_maximum, is_concave=False):
+    with player_seed(seed):
+        if is_concave:
+            return [vecfunc.rand.init_sample_1d_concave(0, 1) for _ in val_freq]
+        return [vecfunc.rand.init_sample_1d_uniform(0, 1, f, True, True, l)
+                for f, l in zip(val_freq, val_local_maximum)]
+
+
+def refine_valuation(seed, init_val):
+    with player_seed(seed):
+        return [vecfunc.vecinterp.refine_chaikin_corner_cutting_xy(*v) for v in init_val]
+
+
+def generate_player_valuation(init_seed, refine_seed, val_freq, val_local_maximum, is_concave=False):
+    return refine_valuation(refine_seed, sample_init_valuation(init_seed, val_freq, val_local_maximum, is_concave))
+
+
+def generate_init_valuation(sd: SimulationData, workers=1):
     dist_data = sd.dist_data
 
     sd.log("Generating valuations: initial func.")
 
-    val_freq = dist_data['val-freq']
+    seeds = get_player_seeds(sd, STAGE_INIT_VALUATION)
     is_concave = sd.meta['valuation'].setdefault('concave', False)
-    if is_concave:
-        init_val = [[vecfunc.rand.init_sample_1d_concave(0, 1) for _ in fs] for fs in val_freq]
-    else:
-        val_local_maximum = dist_data['val-local-maximum']
-        init_val = [[vecfunc.rand.init_sample_1d_uniform(0, 1, f, True, True, l) for f, l in zip(fs, ls)] for fs, ls
-                    in zip(val_freq, val_local_maximum)]
-
-    sd.init_data['val'] = init_val
+    sd.init_data['val'] = map_players(functools.partial(sample_init_valuation, is_concave=is_concave), seeds,
+                                      dist_data['val-freq'], dist_data['val-local-maximum'], workers=workers)
 
 
-def generate_valuation(sd: SimulationData):
+def generate_valuation(sd: SimulationData, workers=1):
     sd.log("Generating valuations: refine.")
 
-    init_val = sd.init_data['val']
-    val_xy = [[vecfunc.vecinterp.refine_chaikin_corner_cutting_xy(*v) for v in vs] for vs in init_val]
-    sd.data['val-xy'] = val_xy
+    seeds = get_player_seeds(sd, STAGE_REFINE_VALUATION)
+    sd.data['val-xy'] = map_players(refine_valuation, seeds, sd.init_data['val'], workers=workers)
+
+
+def generate_valuation_spline(sd: SimulationData):
+    """ Stores the stacked splines of the valuations with the item, as the shards do (see `shards.write_shard()`) """
+    sd.log("Generating valuations: splines.")
+    val_xy = sd.data['val-xy']
+    ppoly = produce.build_vals_spline_ppoly(val_xy)
+    ppoly['digest'] = produce.get_val_xy_digest(val_xy)
+    sd.data['val-spline-ppoly'] = ppoly
+
+
+def generate_valuation_sharded(sd: SimulationData, workers=1):
+    """
+    Generates the valuations shard by shard (see `shards`), so only a single shard is held in memory.
+    Yields the same valuations as `generate_init_valuation()` followed by `generate_valuation()`.
+    """
+    dist_data = sd.dist_data
+    shard_size = shards.get_shard_size(sd)
+    sd.log("Generating valuations: %d players per shard." % shard_size)
+
+    shards_rel_dir = shards.create_shards_dir(sd)
+    shards_dir = os.path.join(shards.get_item_dir(sd), shards_rel_dir)
+    init_seeds = get_player_seeds(sd, STAGE_INIT_VALUATION)
+    refine_seeds = get_player_seeds(sd, STAGE_REFINE_VALUATION)
+    is_concave = sd.meta['valuation'].setdefault('concave', False)
+    func = functools.partial(generate_player_valuation, is_concave=is_concave)
+
+    digests = []
+    with get_players_executor(workers) as executor:
+        for shard, (p0, p1) in enumerate(shards.get_shard_ranges(sd.n, shard_size)):
+            val_xy = map_players(func, init_seeds[p0:p1], refine_seeds[p0:p1], dist_data['val-freq'][p0:p1],
+                                 dist_data['val-local-maximum'][p0:p1], executor=executor)
+            shards.write_shard(shards_dir, shard, val_xy, produce.build_vals_spline_ppoly(val_xy))
+            digests.append(produce.get_val_xy_digest(val_xy))
+
+    sd.meta['shards'] = {'dir': shards_rel_dir, 'size': shard_size, 'digests': digests}
+
+
+def sample_resource_dependency(n, ndim, actions, p):
+    """
+    Samples the resource dependency trees of `n` players at once.
+    In each step, every player combines a uniformly drawn ordered pair of its remaining nodes (i0, i1)
+    with an action drawn from `actions` with probabilities `p`, and i0 is removed.
+    Returns the trees in their compact form (see `produce.get_dependency_edges()`):
+    an (n, ndim-1, 3) integer array of [action-code, i0, i1] rows.
+    """
+    action_codes = np.array([produce.DEPENDENCY_ACTIONS.index(a) for a in actions])
+    ret = np.empty((n, max(ndim - 1, 0), 3), dtype=np.int8)
+    ret[:, :, 0] = action_codes[np.random.choice(len(actions), p=p, size=(n, max(ndim - 1, 0)))]
+
+    players = np.arange(n)
+    remaining = np.tile(np.arange(ndim), (n, 1))
+    for step, r in enumerate(range(ndim, 1, -1)):
+        k0 = np.random.randint(0, r, n)
+        k1 = np.random.randint(0, r - 1, n)
+        k1 += k1 >= k0
+        ret[:, step, 1] = remaining[players, k0]
+        ret[:, step, 2] = remaining[players, k1]
+        # Removes i0 by replacing it with the last remaining node
+        remaining[players, k0] = remaining[:, r - 1]
+    return ret
 
 
 def generate_resource_dependency(sd: SimulationData):
@@ -132,23 +266,7 @@ def generate_resource_dependency(sd: SimulationData):
     # 'c': complementary
     # 's': substitute
     # 'm': multiply
-    # output: [('c', 0, 1), ('s', 2,3), ('c', 1,3)]
-    dependencies_cs = [], ['c', 's'], [0.7, 0.3]
-    dependencies_csm = [], ['c', 's', 'm'], [0.6, 0.3, 0.1]
-    dependencies_sm = [], ['s', 'm'], [0.3, 0.7]
-    for d, c, p in (dependencies_cs, dependencies_csm, dependencies_sm):
-        for _ in range(n):
-            t = []
-            dim_set = set(range(ndim))
-            action_ser = list(np.random.choice(c, p=p, size=ndim-1))
-            while len(dim_set) > 1:
-                nodes = list(np.random.choice(list(dim_set), size=2, replace=False))
-                action = action_ser.pop()
-                t.append((action, nodes))
-                dim_set.remove(nodes[0])
-
-            d.append(t)
-
-    sd.data['resource_dependency_cs'] = dependencies_cs[0]
-    sd.data['resource_dependency_csm'] = dependencies_csm[0]
-    sd.data['resource_dependency_sm'] = dependencies_sm[0]
+    with player_seed(get_stage_seed(sd, STAGE_RESOURCE_DEPENDENCY)):
+        sd.data['resource_dependency_cs'] = sample_resource_dependency(n, ndim, ['c', 's'], [0.7, 0.3])
+        sd.data['resource_dependency_csm'] = sample_resource_dependency(n, ndim, ['c', 's', 'm'], [0.6, 0.3, 0.1])
+        sd.data['resource_dependency_sm'] = sample_resource_dependency(n, ndim, ['s', 'm'], [0.3, 0.7])
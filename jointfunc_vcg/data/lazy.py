@@ -0,0 +1,120 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+from jointfunc_vcg.data import produce
+
+
+class LazyVals:
+    """
+    A lazy representation of the valuations of a set of players.
+    The valuations are exact compositions of each player's 1D slices under min/max/multiply, so only the
+    slices, the wealth factor and the resource dependency are stored. Hence, its memory is proportional
+    to the sum of the dimensions' sizes rather than their product.
+
+    Indexing, e.g., `lazy[p, 10:20, :, 3]`, evaluates only the requested block. The first index selects
+    the players. Index arrays are applied to each dimension separately (like `np.ix_`).
+    `materialize()` (or `np.asarray(lazy)`) evaluates the full (n, *shape) block.
+    """
+    def __init__(self, per_dim, wealth=None, func=np.multiply, dep=None):
+        self.per_dim = per_dim
+        self.wealth = wealth
+        self.func = func
+        self.dep = dep
+        self.shape = (len(per_dim[0]), *(v.shape[1] for v in per_dim))
+        self.ndim = len(self.shape)
+        self.dtype = np.result_type(*per_dim)
+
+    @property
+    def nbytes(self):
+        return sum(v.nbytes for v in self.per_dim) + (0 if self.wealth is None else self.wealth.nbytes)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None):
+        ret = self.materialize()
+        return ret if dtype is None else ret.astype(dtype, copy=False)
+
+    def materialize(self):
+        return self[...]
+
+    def normalize_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        ellipsis = [i for i, k in enumerate(key) if k is Ellipsis]
+        if len(ellipsis) > 1:
+            raise IndexError("An index can only have a single ellipsis ('...').")
+        if ellipsis:
+            i = ellipsis[0]
+            key = (*key[:i], *(slice(None),) * (self.ndim - len(key) + 1), *key[i + 1:])
+        if len(key) > self.ndim:
+            raise IndexError(f"Too many indices: valuations are {self.ndim}-dimensional.")
+        return (*key, *(slice(None),) * (self.ndim - len(key)))
+
+    def __getitem__(self, key):
+        idx = [np.arange(s)[k] for s, k in zip(self.shape, self.normalize_key(key))]
+        drop = tuple(0 if np.ndim(i) == 0 else slice(None) for i in idx)
+        players, *idx = [np.atleast_1d(i) for i in idx]
+
+        ndim = len(idx)
+        views = [np.reshape(v[players][:, i], (len(players), *(len(i) if d == dd else 1 for dd in range(ndim))))
+                 for d, (v, i) in enumerate(zip(self.per_dim, idx))]
+
+        if self.dep is None:
+            ret = produce.reduce_vals_slices(self.func, views)
+        else:
+            ret = np.empty((len(players), *map(len, idx)), dtype=self.dtype)
+            for j, p in enumerate(players):
+                produce.reduce_vals_dependency([v[j] for v in views], self.dep[p], ret[j])
+
+        if self.wealth is not None:
+            ret *= np.reshape(self.wealth[players], (-1,) + (1,) * ndim)
+        return ret[drop]
+
+
+def get_vals(sd, shape, ndim, factor_wealth=True, players=None, resource_dependency=None, dtype=None):
+    """
+    Same as `produce.get_vals(..., as_block=True)`, but the valuations are returned as a `LazyVals`.
+    Evaluating any block of it yields identical results to the dense valuations.
+    """
+    if isinstance(shape, int):
+        shape = (shape,)
+    assert ndim == len(shape)
+    if players is None:
+        players = range(sd.n)
+    players = np.asarray(players, dtype=int)
+
+    per_dim = produce.get_vals_slices_per_dim(sd, shape, ndim, factor_wealth=False, players=players)
+    per_dim = [v.astype(float if dtype is None else dtype, copy=False) for v in per_dim]
+    func, dep = produce.get_resource_dependency(sd, resource_dependency, players)
+
+    wealth = None
+    val_per_dim = per_dim
+    if factor_wealth:
+        wealth = np.asarray(sd.dist_data['wealth'])[players]
+        if ndim > 1:
+            part_wealth = np.reshape(np.divide(wealth, ndim), (-1, 1))
+            val_per_dim = [(v * part_wealth).astype(v.dtype, copy=False) for v in per_dim]
+
+    return produce.stack_vals_slices(val_per_dim), LazyVals(per_dim, wealth, func, dep)
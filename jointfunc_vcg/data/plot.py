@@ -51,16 +51,17 @@ def plot_vals_slice(sd, sz=1024, players=None, range_start=0, range_count=4):
         range_count = len(players)
 
     val_x = produce.get_val_x(sd, sz, sd.ndim)
-    val_slices = produce.get_vals_slices(sd, sz, sd.ndim, factor_wealth=True)
+    # Only the plotted players are produced (and only their shards are read, see `shards`)
+    val_slices = produce.get_vals_slices(sd, sz, sd.ndim, factor_wealth=True, players=players)
 
     rows = np.ceil(range_count / 4)
     plt.figure(figsize=(16, 4 * rows))
     t = 1
-    for i in players:
+    for i, player_slices in zip(players, val_slices):
         plt.subplot(rows, 4, t)
         t += 1
         plt.title('Player: %s' % i)
-        for d, (v, x) in enumerate(zip(val_slices[i], val_x)):
+        for d, (v, x) in enumerate(zip(player_slices, val_x)):
             plt.plot(x, v, label=str(d))
 
         plt.legend()
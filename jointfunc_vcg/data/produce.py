@@ -16,10 +16,15 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import os
 import numpy as np
 import functools
+import hashlib
+import concurrent.futures
 import vecfunc
-from scipy.interpolate import CubicSpline
+from scipy.interpolate import CubicSpline, PPoly
+
+from jointfunc_vcg.data import shards
 
 
 def get_val_fake_x(sd, shape, ndim=None):
@@ -40,39 +45,422 @@ def get_val_x(sd, shape, ndim=None):
     return val_x
 
 
+def get_val_xy_digest(val_xy):
+    """ Returns a digest of the valuations' control points, used to invalidate derived caches """
+    h = hashlib.sha1()
+    for vs in val_xy:
+        for v in vs:
+            for a in v[:2]:
+                a = np.ascontiguousarray(a, dtype=float)
+                h.update(np.int64(a.size).tobytes())
+                h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def get_item_val_xy_digest(sd):
+    """ Returns the digest of the item's valuations' control points, whether they are sharded or not """
+    if shards.is_sharded(sd):
+        return shards.get_val_xy_digest(sd)
+    return get_val_xy_digest(sd.data['val-xy'])
+
+
+def build_vals_spline_ppoly(val_xy):
+    """
+    Builds the natural cubic spline of each player's valuation in each dimension, and stacks
+    their piecewise polynomial representation into padded arrays:
+     - 'x': (n, ndim, m) breakpoints (padded by repeating the last breakpoint)
+     - 'c': (4, n, ndim, m-1) coefficients (padded with zeros)
+     - 'size': (n, ndim) the number of breakpoints of each spline
+    """
+    splines = [[CubicSpline(np.array(v[0]), np.array(v[1]), bc_type='natural') for v in vs] for vs in val_xy]
+    size = np.array([[len(s.x) for s in ss] for ss in splines], dtype=int)
+    n, ndim = size.shape
+    m = size.max()
+
+    x = np.empty((n, ndim, m), dtype=float)
+    c = np.zeros((4, n, ndim, m - 1), dtype=float)
+    for i, ss in enumerate(splines):
+        for d, s in enumerate(ss):
+            k = len(s.x)
+            x[i, d, :k] = s.x
+            x[i, d, k:] = s.x[-1]
+            c[:, i, d, :k - 1] = s.c
+    return {'x': x, 'c': c, 'size': size}
+
+
+def get_vals_spline_ppoly(sd):
+    """
+    Returns the stacked spline representation of the valuations (see `build_vals_spline_ppoly()`).
+    It is stored with the dataset item by its 'valuation-spline' generation stage (see `stages`).
+    For an item that does not have it, it is built once per simulation data and cached.
+    The representation is ignored whenever 'val-xy' changes.
+    The representation of a sharded item (see `shards`) is read from its shards.
+    """
+    if shards.is_sharded(sd):
+        return shards.get_vals_spline_ppoly(sd)
+
+    digest = get_val_xy_digest(sd.data['val-xy'])
+    for ppoly in (sd.data.get('val-spline-ppoly', None), sd.internal.get('val-spline-ppoly', None)):
+        if ppoly is not None and ppoly['digest'] == digest:
+            return ppoly
+
+    ppoly = build_vals_spline_ppoly(sd.data['val-xy'])
+    ppoly['digest'] = digest
+    sd.internal['val-spline-ppoly'] = ppoly
+    return ppoly
+
+
 def get_vals_spline(sd):
+    ppoly = get_vals_spline_ppoly(sd)
     val_spline = sd.internal.get('val-spline', None)
-    if val_spline is None:
-        val_xy = sd.data['val-xy']
-        val_spline = [[CubicSpline(np.array(v[0]), np.array(v[1]), bc_type='natural') for v in vs] for vs in val_xy]
+    if val_spline is None or sd.internal.get('val-spline-digest', None) != ppoly['digest']:
+        x, c = ppoly['x'], ppoly['c']
+        val_spline = [[PPoly.construct_fast(np.ascontiguousarray(c[:, i, d, :k - 1]), x[i, d, :k])
+                       for d, k in enumerate(ks)] for i, ks in enumerate(ppoly['size'])]
+        sd.internal['val-spline'] = val_spline
+        sd.internal['val-spline-digest'] = ppoly['digest']
     return val_spline
 
 
-def get_vals_slices(sd, shape, ndim=None, factor_wealth=True):
-    val_spline = get_vals_spline(sd)
+def eval_vals_spline_batch(ppoly, d, x, players=None):
+    """
+    Evaluates the splines of dimension `d` of all the players (or only `players`) on the
+    sorted points `x`, using the stacked representation from `get_vals_spline_ppoly()`.
+    Yields the same values as evaluating each spline separately.
+    Returns an array of shape (n, len(x)).
+    """
+    if players is None:
+        players = slice(None)
+    bx = ppoly['x'][players, d]
+    c = ppoly['c'][:, players, d]
+    size = ppoly['size'][players, d]
+    n, m = bx.shape
+
+    # A point falls in interval i if exactly i of the interior breakpoints are smaller or equal to it.
+    # Points outside the range are extrapolated using the first/last interval.
+    cols = np.arange(m)
+    rows, cols = np.nonzero((cols >= 1) & (cols < size[:, None] - 1))
+    counts = np.zeros((n, len(x) + 1), dtype=np.intp)
+    np.add.at(counts, (rows, np.searchsorted(x, bx[rows, cols], side='left')), 1)
+    interval = np.cumsum(counts[:, :-1], axis=1)
+
+    rows = np.arange(n)[:, None]
+    dx = x - bx[rows, interval]
+    ret = c[3][rows, interval]
+    z = dx.copy()
+    for k in (2, 1, 0):
+        ret += c[k][rows, interval] * z
+        if k > 0:
+            z *= dx
+    return ret
+
+
+def stack_vals_slices(per_dim):
+    """
+    Stacks per dimension slices arrays, each of shape (n, sz_d), to an (n, ndim, sz) array.
+    If the dimensions' sizes differ, an (n, ndim) object array of the slices is returned instead.
+    """
+    if len(set(v.shape[1] for v in per_dim)) == 1:
+        return np.stack(per_dim, axis=1)
+
+    n = len(per_dim[0])
+    ret = np.empty((n, len(per_dim)), dtype=object)
+    for d, v in enumerate(per_dim):
+        for i in range(n):
+            ret[i, d] = v[i]
+    return ret
+
+
+def unstack_vals_slices(val_slices):
+    """ The inverse of `stack_vals_slices()` """
+    if val_slices.dtype == object:
+        return [np.stack(val_slices[:, d]) for d in range(val_slices.shape[1])]
+    return [val_slices[:, d] for d in range(val_slices.shape[1])]
+
+
+def get_vals_slices_per_dim(sd, shape, ndim=None, factor_wealth=True, players=None):
+    """ Returns a list with an array of shape (n, sz_d) of the valuation slices in each dimension """
     val_fake_x = get_val_fake_x(sd, shape, ndim)
+    if players is not None:
+        players = np.asarray(players, dtype=int)
 
-    ret = [[v(x) for v, x in zip(vs, val_fake_x)] for vs in val_spline]
+    if shards.is_sharded(sd):
+        # Only the shards of the players are read
+        ppoly = shards.get_vals_spline_ppoly(sd, players)
+        ret = [eval_vals_spline_batch(ppoly, d, x) for d, x in enumerate(val_fake_x)]
+    else:
+        ppoly = get_vals_spline_ppoly(sd)
+        ret = [eval_vals_spline_batch(ppoly, d, x, players) for d, x in enumerate(val_fake_x)]
     if factor_wealth:
         wealth = sd.dist_data['wealth']
-        for i in range(sd.n):
-            for d in range(ndim):
-                ret[i][d] *= wealth[i]
+        if players is not None:
+            wealth = wealth[players]
+        for v in ret:
+            v *= np.reshape(wealth, (-1, 1))
 
     is_concave = sd.meta['valuation'].setdefault('concave', False)
     r = sd.meta['valuation'].setdefault('local-maximum-limit', None)
     is_rising = r is None or r <= 0
 
-    for i, vs in enumerate(ret):
-        for d, v in enumerate(vs):
-            if is_concave:
-                ret[i][d] = vecfunc.fix_concave_rising(v).arr
-            elif is_rising:
-                ret[i][d] = vecfunc.fix_rising(v).arr
+    for v in ret:
+        if is_concave:
+            for i in range(len(v)):
+                v[i] = vecfunc.fix_concave_rising(v[i]).arr
+        elif is_rising:
+            np.maximum.accumulate(v, axis=-1, out=v)
     return ret
 
 
-def get_vals(sd, shape, ndim, factor_wealth=True, players=None, resource_dependency=None):
+def get_vals_slices_array(sd, shape, ndim=None, factor_wealth=True, players=None):
+    """ Returns the valuation slices of all the players as an (n, ndim, sz) array (see `stack_vals_slices()`) """
+    return stack_vals_slices(get_vals_slices_per_dim(sd, shape, ndim, factor_wealth, players))
+
+
+def get_vals_slices(sd, shape, ndim=None, factor_wealth=True, players=None):
+    per_dim = get_vals_slices_per_dim(sd, shape, ndim, factor_wealth, players)
+    return [list(vs) for vs in zip(*per_dim)]
+
+
+DEPENDENCY_ACTIONS = 'c', 's', 'm'
+DEPENDENCY_GROUP_MAX_BYTES = 2 ** 27
+CHUNKS_PER_WORKER = 4
+
+resource_dependency_func_options = {
+    'complementary': np.minimum,
+    'c': np.minimum,
+    'substitute': np.maximum,
+    's': np.maximum,
+    'multiply': np.multiply,
+    'm': np.multiply,
+}
+
+
+def reduce_vals_slices(func, views, out=None):
+    """
+    Reduces broadcastable views of a player's slices (e.g., `np.meshgrid(..., sparse=True)`) with `func`
+    directly into `out` (allocated if not given), without creating dense copies of the grid.
+    """
+    if out is None:
+        out = np.empty(np.broadcast(*views).shape, dtype=np.result_type(*views))
+    if len(views) == 1:
+        out[...] = views[0]
+        return out
+
+    func(views[0], views[1], out=out)
+    for v in views[2:]:
+        func(out, v, out=out)
+    return out
+
+
+def get_dependency_edges(tree):
+    """
+    Returns the edges of a player's resource dependency tree as a list of (action, (i0, i1)).
+    The tree is either a list of such edges, or its compact form: an integer array with a row
+    of [action-code, i0, i1] per edge (the action is `DEPENDENCY_ACTIONS[action-code]`).
+    """
+    if isinstance(tree, np.ndarray):
+        return [(DEPENDENCY_ACTIONS[a], (int(i0), int(i1))) for a, i0, i1 in tree]
+    return [(str(a), (int(i0), int(i1))) for a, (i0, i1) in tree]
+
+
+def compile_dependency_tree(tree, ndim):
+    """
+    Compiles a player's resource dependency tree over `ndim` dimensions to a sequence of steps: (op, node0, node1).
+    Nodes 0..ndim-1 are the slices, and each step adds a node. Returns (steps, result_node).
+    """
+    mm = {i: i for i in range(ndim)}
+    steps = []
+    for a, (i0, i1) in get_dependency_edges(tree):
+        n0 = mm.pop(i0, None)
+        n1 = mm.pop(i1, None)
+        if n0 is None:
+            mm[i1] = n1
+        elif n1 is None:
+            mm[i1] = n0
+        else:
+            steps.append((a.lower(), n0, n1))
+            mm[i1] = ndim + len(steps) - 1
+
+    assert len(mm) == 1, f'Result len: {len(mm)}'
+    return tuple(steps), mm[next(iter(mm))]
+
+
+def reduce_vals_steps(views, steps, result, out=None):
+    """
+    Reduces broadcastable views of the slices according to compiled dependency steps (see `compile_dependency_tree()`).
+    The views may have a leading players axis, to evaluate a group of players with the same steps at once.
+    Intermediate nodes only span the dimensions below them, and the first node that spans all the
+    dimensions is computed directly into `out` (allocated if not given).
+    """
+    full_shape = np.broadcast(*views).shape
+    nodes = list(views)
+    owned = [False] * len(nodes)
+    for op, n0, n1 in steps:
+        a, b = nodes[n0], nodes[n1]
+        nodes[n0] = nodes[n1] = None
+        shape = np.broadcast(a, b).shape
+        target = next((x for x, k in ((a, n0), (b, n1)) if owned[k] and x.shape == shape), None)
+        if target is None and shape == full_shape and out is not None and all(x is not out for x in nodes):
+            target = out
+        nodes.append(resource_dependency_func_options[op](a, b, out=target))
+        owned.append(True)
+        del a, b
+
+    ret = nodes[result]
+    if ret is out or (owned[result] and out is None):
+        return ret
+    return reduce_vals_slices(None, (ret,), out)
+
+
+def reduce_vals_dependency(views, dep, out=None):
+    """ Reduces broadcastable views of a player's slices according to the player's resource dependency tree """
+    steps, result = compile_dependency_tree(dep, len(views))
+    return reduce_vals_steps(views, steps, result, out)
+
+
+def get_dependency_plan(sd, resource_dependency, ndim):
+    """
+    Compiles the resource dependency trees of all the players once per dataset item (cached in `sd.internal`).
+    Returns (topologies, player_topology): a list of the distinct compiled trees (steps, result_node),
+    and the index of each player's tree in that list. Players with the same compiled tree can be evaluated
+    together.
+    The cache is valid as long as the item's dependency trees are the same object (they are replaced, not
+    modified, when they are generated), so a lookup does not depend on the number of players.
+    """
+    k = f'resource_dependency_{resource_dependency}'
+    trees = sd.data[k]
+    cached_trees, plans = sd.internal.get(k + '-plan', (None, None))
+    if cached_trees is not trees:
+        plans = {}
+        sd.internal[k + '-plan'] = trees, plans
+
+    if ndim not in plans:
+        topology_index = {}
+        player_topology = [topology_index.setdefault(compile_dependency_tree(t, ndim), len(topology_index))
+                           for t in trees]
+        plans[ndim] = list(topology_index), np.array(player_topology, dtype=int)
+    return plans[ndim]
+
+
+def reduce_vals_plan(plan, per_dim, players, vals):
+    """
+    Reduces the slices of the players according to their compiled resource dependency trees
+    (`plan`, see `get_dependency_plan()`).
+    Players that share the same compiled tree are evaluated together, as one stacked array operation per edge
+    (in chunks of at most `DEPENDENCY_GROUP_MAX_BYTES`).
+    `vals` is either an (n, *shape) block or a list, to which the players' valuations are written.
+    """
+    shape = tuple(v.shape[1] for v in per_dim)
+    ndim = len(shape)
+    topologies, player_topology = plan
+    player_topology = player_topology[players]
+    chunk_size = max(1, DEPENDENCY_GROUP_MAX_BYTES // (int(np.prod(shape)) * np.result_type(*per_dim).itemsize))
+
+    for t in np.unique(player_topology):
+        steps, result = topologies[t]
+        pos = np.nonzero(player_topology == t)[0]
+        for chunk in np.array_split(pos, np.arange(chunk_size, len(pos), chunk_size)):
+            views = [np.reshape(v[chunk], (len(chunk), *(s if d == dd else 1 for dd in range(ndim))))
+                     for d, (v, s) in enumerate(zip(per_dim, shape))]
+            is_range = chunk[-1] - chunk[0] + 1 == len(chunk)
+            if isinstance(vals, np.ndarray) and is_range:
+                reduce_vals_steps(views, steps, result, vals[chunk[0]:chunk[-1] + 1])
+                continue
+
+            r = reduce_vals_steps(views, steps, result)
+            if isinstance(vals, np.ndarray):
+                vals[chunk] = r
+            else:
+                for j, i in enumerate(chunk):
+                    vals[i] = r[j]
+
+
+def reduce_vals_chunk(resource_dependency_func, dep, plan, per_dim, players, out, chunk, sparse=True, wealth=None):
+    """
+    Reduces the slices of the players in `chunk` (a slice of the players' positions) into their valuations,
+    and multiplies them by their `wealth` (if given).
+    The players' dependency trees are reduced by the `plan` (see `get_dependency_plan()`) if it is given.
+    If `out` is given, the valuations are written into its matching part, otherwise a list is returned.
+    """
+    per_dim = [v[chunk] for v in per_dim]
+    players = players[chunk]
+    if out is not None:
+        out = out[chunk]
+    vals = out if out is not None else [None] * len(players)
+
+    if plan is not None:
+        reduce_vals_plan(plan, per_dim, players, vals)
+    else:
+        reduce_vals_meshes(resource_dependency_func, None if dep is None else dep[chunk], per_dim, vals, sparse)
+
+    if wealth is not None:
+        wealth = wealth[chunk]
+        if out is not None:
+            vals *= np.reshape(wealth, (-1,) + (1,) * (out.ndim - 1))
+        else:
+            for i, w in enumerate(wealth):
+                vals[i] *= w
+    return vals
+
+
+def reduce_vals_meshes(resource_dependency_func, dep, per_dim, vals, sparse=True):
+    """ Reduces the meshgrid of each player's slices one player at a time into `vals` (a block or a list) """
+    is_block = isinstance(vals, np.ndarray)
+    for i, vs in enumerate(zip(*per_dim)):
+        m = np.meshgrid(*vs, sparse=sparse, indexing='ij')
+        o = vals[i] if is_block else None
+        if dep is not None:
+            v = reduce_vals_dependency(m, dep[i], o)
+        elif sparse:
+            v = reduce_vals_slices(resource_dependency_func, m, o)
+        else:
+            v = functools.reduce(resource_dependency_func, m)
+            if o is not None:
+                o[...] = v
+        if not is_block:
+            vals[i] = v
+
+
+def get_resource_dependency(sd, resource_dependency, players):
+    """
+    Returns the reduce function of the resource dependency, or the dependency tree of each player
+    if it is a named dependency of the dataset (e.g., 'cs') as a tuple: (func, dep).
+    """
+    if resource_dependency is None:
+        resource_dependency = 'multiply'
+
+    resource_dependency_func = resource_dependency_func_options.get(resource_dependency.lower())
+    if resource_dependency_func:
+        return resource_dependency_func, None
+
+    k = f'resource_dependency_{resource_dependency}'
+    if k not in sd.data:
+        raise KeyError(f"No such resource dependency: {resource_dependency}.")
+    dep = sd.data[k]
+    return None, [dep[p] for p in players]
+
+
+def get_vals(sd, shape, ndim, factor_wealth=True, players=None, resource_dependency=None, sparse=True,
+             as_block=False, out=None, dtype=None, workers=None, executor=None):
+    """
+    Produces the valuation tensors of the players.
+    If `sparse` is set (default), each tensor is reduced from broadcastable views of the slices
+    straight into its own output buffer. Otherwise, the slices are expanded to dense meshgrids first.
+    Both modes yield identical results.
+
+    By default, returns the slices as nested lists and the valuations as a list of arrays.
+    If `as_block` is set, or an `out` buffer of shape (len(players), *shape) is given, the valuations
+    are filled in place into a single C-contiguous block of that shape, and the slices are returned
+    as a stacked array (see `stack_vals_slices()`).
+
+    The slices are evaluated in float64, and then the valuations are produced in `dtype` (default: float64,
+    or the dtype of `out`). E.g., use float32 to halve the memory and bandwidth of the valuations.
+
+    The players can be produced in parallel, in chunks, by a thread pool of `workers` threads, or by the given
+    `executor`, which must be a thread pool. The reductions are numpy operations that release the GIL.
+    Each chunk is written into its own part of the shared output, so the results are identical and ordered
+    regardless of the number of workers.
+    """
     if isinstance(shape, int):
         shape = (shape,)
     if not type(shape) in (list, tuple):
@@ -81,60 +469,51 @@ def get_vals(sd, shape, ndim, factor_wealth=True, players=None, resource_depende
 
     if players is None:
         players = range(sd.n)
+    players = np.asarray(players, dtype=int)
 
-    val_slices = get_vals_slices(sd, shape, ndim, factor_wealth=False)
-    val_slices = [val_slices[p] for p in players]
-    meshes = (np.meshgrid(*vs, sparse=False, indexing='ij') for vs in val_slices)
+    if dtype is None:
+        dtype = float if out is None else out.dtype
+    as_block = as_block or out is not None
+    if executor is not None and not isinstance(executor, concurrent.futures.ThreadPoolExecutor):
+        # The chunks are written in place, so a process pool would write them into copies of the output
+        raise TypeError("The executor must be a ThreadPoolExecutor.")
+    if as_block:
+        if out is None:
+            out = np.empty((len(players), *shape), dtype=dtype)
+        if out.shape != (len(players), *shape) or not out.flags.c_contiguous:
+            raise ValueError(f"Output buffer must be a C-contiguous array of shape {(len(players), *shape)}.")
 
-    if resource_dependency is None:
-        resource_dependency = 'multiply'
-    resource_dependency_func_options = {
-        'complementary': np.minimum,
-        'c': np.minimum,
-        'substitute': np.maximum,
-        's': np.maximum,
-        'multiply': np.multiply,
-        'm': np.multiply,
-    }
+    per_dim = get_vals_slices_per_dim(sd, shape, ndim, factor_wealth=False, players=players)
+    per_dim = [v.astype(dtype, copy=False) for v in per_dim]
+    val_slices = [list(vs) for vs in zip(*per_dim)]
+    resource_dependency_func, dep = get_resource_dependency(sd, resource_dependency, players)
+    # Resolved once for all the chunks
+    plan = get_dependency_plan(sd, resource_dependency, ndim) if dep is not None and sparse else None
 
-    resource_dependency_func = resource_dependency_func_options.get(resource_dependency.lower())
+    wealth = np.asarray(sd.dist_data['wealth'])[players] if factor_wealth else None
 
-    if resource_dependency_func:
-        vals = [functools.reduce(resource_dependency_func, m) for m in meshes]
+    def reduce_chunk(chunk):
+        return reduce_vals_chunk(resource_dependency_func, dep, plan, per_dim, players, out, chunk, sparse, wealth)
+
+    if executor is None and (workers is None or workers <= 1):
+        vals = reduce_chunk(slice(0, len(players)))
     else:
-        k = f'resource_dependency_{resource_dependency}'
-        if k not in sd.data:
-            raise KeyError(f"No such resource dependency: {resource_dependency}.")
-        dep = sd.data[k]
-        dep = [dep[p] for p in players]
-
-        vals = []
-        for m, d in zip(meshes, dep):
-            mm = {i: sm for i, sm in enumerate(m)}
-            assert len(mm) == ndim, f'Initial len: {len(mm)}'
-            for a, (i0, i1) in d:
-                n0 = mm.pop(i0, None)
-                n1 = mm.pop(i1, None)
-                if n0 is None:
-                    mm[i1] = n1
-                elif n1 is None:
-                    mm[i1] = n0
-                else:
-                    resource_dependency_func = resource_dependency_func_options[a.lower()]
-                    mm[i1] = resource_dependency_func(n0, n1)
-
-            assert len(mm) == 1, f'Result len: {len(mm)}'
-            vals.append(mm[next(iter(mm))])
+        n_chunks = min(len(players), CHUNKS_PER_WORKER * (workers or os.cpu_count() or 1))
+        bounds = np.linspace(0, len(players), n_chunks + 1).astype(int)
+        chunks = [slice(b0, b1) for b0, b1 in zip(bounds[:-1], bounds[1:]) if b1 > b0]
+        if executor is None:
+            with concurrent.futures.ThreadPoolExecutor(workers) as ex:
+                vals = list(ex.map(reduce_chunk, chunks))
+        else:
+            vals = list(executor.map(reduce_chunk, chunks))
+        vals = out if as_block else [v for chunk_vals in vals for v in chunk_vals]
 
-    if factor_wealth:
-        wealth = sd.dist_data['wealth']
-        for i, p in enumerate(players):
-            vals[i] *= wealth[p]
-
-        if ndim > 1:
-            part_wealth = np.divide(wealth, ndim)
-            for i, p in enumerate(players):
-                for d in range(ndim):
-                    val_slices[i][d] *= part_wealth[p]
+    if factor_wealth and ndim > 1:
+        part_wealth = np.divide(wealth, ndim)
+        for v in per_dim:
+            v *= np.reshape(part_wealth, (-1, 1))
+
+    if as_block:
+        val_slices = stack_vals_slices(per_dim)
 
     return val_slices, vals
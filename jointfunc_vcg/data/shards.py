@@ -0,0 +1,161 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import functools
+import numpy as np
+
+"""
+A sharded layout of the players' valuations, for dataset items with many players.
+When the item's metadata sets 'shard-size', the valuations are generated and written shard by shard
+(each shard holds 'shard-size' consecutive players) instead of being stored in `sd.data['val-xy']`.
+Each shard stores the players' control points and their stacked spline representation
+(see `produce.build_vals_spline_ppoly()`), so only the shards of the requested players are read.
+The shards are stored in the item's directory, with the rest of its data, and their layout is recorded in
+`sd.meta['shards']`, with a path relative to the item's directory.
+"""
+
+SHARDS_SUBDIR = 'shards'
+SHARD_CACHE_SIZE = 16
+
+
+def get_shard_size(sd):
+    """ Returns the configured shard size of the item, or None if it should not be sharded """
+    return sd.meta.get('shard-size', None)
+
+
+def is_sharded(sd):
+    return 'shards' in sd.meta
+
+
+def get_item_dir(sd):
+    """ Returns the directory of the dataset item, in which its data is stored """
+    return sd.path
+
+
+def create_shards_dir(sd):
+    """
+    Creates a directory for the item's shards in the item's directory, unique to its parameters.
+    Returns its path, relative to the item's directory.
+    """
+    h = hashlib.sha1(json.dumps({
+        'seed': int(sd.seed),
+        'n': int(sd.n),
+        'ndim': int(sd.ndim),
+        'valuation': sd.meta['valuation'],
+    }, sort_keys=True, default=str).encode())
+    ret = os.path.join(SHARDS_SUBDIR, h.hexdigest())
+    os.makedirs(os.path.join(get_item_dir(sd), ret), exist_ok=True)
+    return ret
+
+
+def get_shards_dir(sd):
+    """ Returns the path of the item's shards directory """
+    return os.path.join(get_item_dir(sd), sd.meta['shards']['dir'])
+
+
+def get_shard_path(shards_dir, shard):
+    return os.path.join(shards_dir, 'shard-%06d.npz' % shard)
+
+
+def get_shard_ranges(n, shard_size):
+    """ Returns the (start, stop) players range of each shard """
+    return [(i, min(i + shard_size, n)) for i in range(0, n, shard_size)]
+
+
+def write_shard(shards_dir, shard, val_xy, ppoly):
+    """ Writes the control points and the stacked splines of the shard's players """
+    arrays = {'x': ppoly['x'], 'c': ppoly['c'], 'size': ppoly['size'],
+              'xy-size': np.array([[len(v[0]) for v in vs] for vs in val_xy], dtype=int)}
+    for d in range(arrays['xy-size'].shape[1]):
+        arrays['xy-x%d' % d] = np.concatenate([np.asarray(vs[d][0], dtype=float) for vs in val_xy])
+        arrays['xy-y%d' % d] = np.concatenate([np.asarray(vs[d][1], dtype=float) for vs in val_xy])
+
+    fd, tmp_path = tempfile.mkstemp(prefix='tmp-', suffix='.npz', dir=shards_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, get_shard_path(shards_dir, shard))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@functools.lru_cache(maxsize=SHARD_CACHE_SIZE)
+def load_shard(path, digest):
+    """ Loads a shard. The digest is only used to invalidate the cached shard when it is rewritten. """
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+
+def get_shard(sd, shard):
+    return load_shard(get_shard_path(get_shards_dir(sd), shard), sd.meta['shards']['digests'][shard])
+
+
+def get_val_xy_digest(sd):
+    """ Returns a digest of the control points of all the shards """
+    h = hashlib.sha1()
+    for digest in sd.meta['shards']['digests']:
+        h.update(digest.encode())
+    return h.hexdigest()
+
+
+def group_players(sd, players=None):
+    """ Yields each shard that holds some of the players, with the players' positions and their index in it """
+    shard_size = sd.meta['shards']['size']
+    players = np.arange(sd.n) if players is None else np.asarray(players, dtype=int)
+    player_shard = players // shard_size
+    for shard in np.unique(player_shard):
+        pos = np.nonzero(player_shard == shard)[0]
+        yield int(shard), pos, players[pos] - shard * shard_size
+
+
+def get_vals_spline_ppoly(sd, players=None):
+    """ Returns the stacked spline representation (see `produce.build_vals_spline_ppoly()`) of the players """
+    groups = [(get_shard(sd, shard), pos, local) for shard, pos, local in group_players(sd, players)]
+    n = sum(len(pos) for _, pos, _ in groups)
+    ndim = groups[0][0]['size'].shape[1]
+    m = max(s['x'].shape[-1] for s, _, _ in groups)
+
+    x = np.empty((n, ndim, m), dtype=float)
+    c = np.zeros((4, n, ndim, m - 1), dtype=float)
+    size = np.empty((n, ndim), dtype=int)
+    for s, pos, local in groups:
+        k = s['x'].shape[-1]
+        x[pos, :, :k] = s['x'][local]
+        x[pos, :, k:] = s['x'][local, :, -1:]
+        c[:, pos, :, :k - 1] = s['c'][:, local]
+        size[pos] = s['size'][local]
+    return {'x': x, 'c': c, 'size': size, 'digest': get_val_xy_digest(sd)}
+
+
+def get_val_xy(sd, players=None):
+    """ Returns the control points of the players, in the same form as `sd.data['val-xy']` """
+    groups = list(group_players(sd, players))
+    ret = [None] * sum(len(pos) for _, pos, _ in groups)
+    for shard, pos, local in groups:
+        s = get_shard(sd, shard)
+        xy_size = s['xy-size']
+        offsets = np.concatenate([np.zeros((1, xy_size.shape[1]), dtype=int), np.cumsum(xy_size, axis=0)])
+        for i, p in zip(pos, local):
+            o0, o1 = offsets[p], offsets[p + 1]
+            ret[i] = [(s['xy-x%d' % d][o0[d]:o1[d]], s['xy-y%d' % d][o0[d]:o1[d]]) for d in range(xy_size.shape[1])]
+    return ret
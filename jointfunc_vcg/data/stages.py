@@ -0,0 +1,250 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import time
+import pickle
+import hashlib
+import tempfile
+
+from cloudsim.sim_data import SimulationData
+from jointfunc_vcg.data import gen, shards
+
+"""
+Incremental generation of a dataset item, stage by stage.
+Each stage records a hash of its parameters and of the hashes of the stages it depends on in `sd.meta['stages']`.
+A stage is only recomputed if its hash changed or its outputs are missing, and the downstream stages follow.
+The outputs of each computed stage can also be kept in a content addressed store, so the items of derived
+datasets (e.g., `increasing` and `concave`) load the stages they share instead of recomputing them.
+The store is opt-in: it is only used if its directory is given (`stages_dir`), or set in the
+JOINTFUNC_VCG_STAGES_DIR environment variable. It is never evicted.
+Stages whose outputs refer to files in the item's directory (i.e., the shards) are not stored.
+"""
+
+STAGES_VERSION = 1
+DEFAULT_STAGES_DIR = os.environ.get('JOINTFUNC_VCG_STAGES_DIR', None)
+
+
+def generate_distributions(sd: SimulationData, workers=1):
+    sd.init_seed()
+    gen.generate_distributions(sd)
+
+
+def generate_init_valuation(sd: SimulationData, workers=1):
+    # A sharded item samples its initial valuations along with the refinement (see `gen.generate_valuation_sharded()`)
+    if shards.get_shard_size(sd) is None:
+        gen.generate_init_valuation(sd, workers=workers)
+
+
+def generate_valuation(sd: SimulationData, workers=1):
+    t1 = time.time()
+    if shards.get_shard_size(sd) is None:
+        gen.generate_valuation(sd, workers=workers)
+    else:
+        gen.generate_valuation_sharded(sd, workers=workers)
+    sd.meta['generate-time'] = time.time() - t1
+
+
+def generate_valuation_spline(sd: SimulationData, workers=1):
+    # A sharded item stores its splines in its shards
+    if shards.get_shard_size(sd) is None:
+        gen.generate_valuation_spline(sd)
+
+
+def generate_resource_dependency(sd: SimulationData, workers=1):
+    gen.generate_resource_dependency(sd)
+
+
+def get_valuation_outputs(sd: SimulationData):
+    if shards.get_shard_size(sd) is None:
+        return ('data', 'val-xy'), ('meta', 'generate-time')
+    return ('meta', 'shards'), ('meta', 'generate-time')
+
+
+"""
+The generation stages, in order:
+ - func: generates the stage's outputs into the item
+ - params: returns the item's parameters the stage depends on (other than its seed, n and ndim)
+ - upstream: the stages whose outputs it depends on
+ - outputs: returns the (container, key) of the stage's outputs
+ - storable: returns False if the stage's outputs cannot be kept in the store (they refer to the item's files)
+"""
+STAGES = {
+    'distributions': {
+        'func': generate_distributions,
+        'params': lambda sd: {k: sd.meta['valuation'].get(k, None) for k in ('wealth-dist', 'local-maximum-limit')},
+        'upstream': (),
+        'outputs': lambda sd: tuple(('dist_data', k) for k in ('val-freq', 'val-local-maximum', 'azure-players',
+                                                               'wealth-uniform', 'wealth')),
+        'storable': lambda sd: True,
+    },
+    'init-valuation': {
+        'func': generate_init_valuation,
+        'params': lambda sd: {'concave': sd.meta['valuation'].get('concave', False),
+                              'shard-size': shards.get_shard_size(sd)},
+        'upstream': ('distributions',),
+        'outputs': lambda sd: (('init_data', 'val'),) if shards.get_shard_size(sd) is None else (),
+        'storable': lambda sd: True,
+    },
+    'valuation': {
+        'func': generate_valuation,
+        'params': lambda sd: {'shard-size': shards.get_shard_size(sd)},
+        'upstream': ('init-valuation',),
+        'outputs': get_valuation_outputs,
+        'storable': lambda sd: shards.get_shard_size(sd) is None,
+    },
+    'valuation-spline': {
+        'func': generate_valuation_spline,
+        'params': lambda sd: {'shard-size': shards.get_shard_size(sd)},
+        'upstream': ('valuation',),
+        'outputs': lambda sd: (('data', 'val-spline-ppoly'),) if shards.get_shard_size(sd) is None else (),
+        'storable': lambda sd: True,
+    },
+    'resource-dependency': {
+        'func': generate_resource_dependency,
+        'params': lambda sd: {},
+        'upstream': (),
+        'outputs': lambda sd: tuple(('data', f'resource_dependency_{k}') for k in ('cs', 'csm', 'sm')),
+        'storable': lambda sd: True,
+    },
+}
+
+
+def get_stage_hash(sd: SimulationData, stage, hashes):
+    """ Returns the hash of a stage's inputs, given the hashes of the stages it depends on """
+    spec = STAGES[stage]
+    h = hashlib.sha1(json.dumps({
+        'version': STAGES_VERSION,
+        'stage': stage,
+        'seed': int(sd.seed),
+        'n': int(sd.n),
+        'ndim': int(sd.ndim),
+        'params': spec['params'](sd),
+        'upstream': [hashes[s] for s in spec['upstream']],
+    }, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def get_outputs(sd: SimulationData, stage):
+    """ Returns the stage's outputs that exist in the item """
+    ret = {}
+    for container, key in STAGES[stage]['outputs'](sd):
+        c = getattr(sd, container)
+        if key in c:
+            ret[container, key] = c[key]
+    return ret
+
+
+def get_stages_dir(stages_dir=None):
+    """ Returns the directory of the store, or None if it is not used (`stages_dir=False`, or no default) """
+    if stages_dir is False:
+        return None
+    if stages_dir is None:
+        return DEFAULT_STAGES_DIR
+    return stages_dir
+
+
+def get_store_path(stages_dir, stage_hash):
+    return os.path.join(stages_dir, stage_hash + '.pkl')
+
+
+def load_outputs(stages_dir, stage_hash):
+    try:
+        with open(get_store_path(stages_dir, stage_hash), 'rb') as f:
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def store_outputs(stages_dir, stage_hash, outputs):
+    os.makedirs(stages_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='tmp-', suffix='.pkl', dir=stages_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(outputs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, get_store_path(stages_dir, stage_hash))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def run_stage(sd: SimulationData, stage, stage_hash, stages_dir=None, workers=1, adopt=True):
+    """
+    Brings a single stage up to date: loads its outputs from the store, or generates them.
+    If `adopt` is set, the existing outputs of an item that was generated before its stages were recorded
+    are adopted as is.
+    Returns None if the stage is up to date, or 'adopted', 'loaded' or 'generated'.
+    """
+    spec = STAGES[stage]
+    recorded = sd.meta.setdefault('stages', {})
+    is_complete = len(get_outputs(sd, stage)) == len(spec['outputs'](sd))
+
+    if recorded.get(stage, None) == stage_hash and is_complete:
+        return None
+    if adopt and stage not in recorded and is_complete:
+        recorded[stage] = stage_hash
+        return 'adopted'
+
+    for c, k in spec['outputs'](sd):
+        getattr(sd, c).pop(k, None)
+
+    stages_dir = get_stages_dir(stages_dir) if spec['storable'](sd) else None
+    outputs = None if stages_dir is None else load_outputs(stages_dir, stage_hash)
+    if outputs is None:
+        sd.log("Generating stage: %s." % stage)
+        spec['func'](sd, workers=workers)
+        if stages_dir is not None:
+            store_outputs(stages_dir, stage_hash, get_outputs(sd, stage))
+        ret = 'generated'
+    else:
+        sd.log("Loaded stage: %s." % stage)
+        for (c, k), v in outputs.items():
+            getattr(sd, c)[k] = v
+        ret = 'loaded'
+
+    recorded[stage] = stage_hash
+    return ret
+
+
+def generate(sd: SimulationData, stages=None, stages_dir=None, workers=1):
+    """
+    Brings the item's stages (default: all of `STAGES`) up to date, and saves the item if any of them changed.
+    The stages' outputs are loaded from and stored in the shared store, if it is used (see `get_stages_dir()`).
+    Set `stages_dir=False` to not use it, even if JOINTFUNC_VCG_STAGES_DIR is set.
+    Returns a dict of the stages that were modified, and how (see `run_stage()`).
+    """
+    sd.init_seed()
+    sd.log("Generating data (seed: %d)..." % sd.seed)
+
+    hashes = {}
+    modified = {}
+    for stage, spec in STAGES.items():
+        hashes[stage] = get_stage_hash(sd, stage, hashes)
+        if stages is not None and stage not in stages:
+            continue
+        adopt = not any(modified.get(s, None) in ('loaded', 'generated') for s in spec['upstream'])
+        ret = run_stage(sd, stage, hashes[stage], stages_dir, workers, adopt=adopt)
+        if ret is not None:
+            modified[stage] = ret
+
+    if modified:
+        sd.save()
+    else:
+        sd.log("Data already generated.")
+    return modified
@@ -0,0 +1,77 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+from jointfunc_vcg.data import lazy
+
+"""
+Produces valuations that are larger than the memory, tile by tile, into a (memory mapped) output.
+Each tile is evaluated from the factored valuations (see `lazy.LazyVals`), so only the slices
+and the tiles that were not yet flushed are held in memory.
+"""
+
+DEFAULT_TILE_BYTES = 2 ** 26
+DEFAULT_MAX_DIRTY_TILES = 16
+
+
+def iter_tiles(shape, itemsize, tile_bytes=DEFAULT_TILE_BYTES):
+    """
+    Yields boxes (tuples of slices) that cover a tensor of the given shape in C order.
+    Each box spans the full trailing dimensions that fit in `tile_bytes`, and a chunk of the dimension before them.
+    """
+    shape = tuple(shape)
+    axis = len(shape) - 1
+    while axis > 0 and int(np.prod(shape[axis:])) * itemsize <= tile_bytes:
+        axis -= 1
+    inner = int(np.prod(shape[axis + 1:])) * itemsize
+    chunk = max(1, tile_bytes // inner)
+
+    for outer in np.ndindex(*shape[:axis]):
+        for start in range(0, shape[axis], chunk):
+            yield (*(slice(i, i + 1) for i in outer), slice(start, min(start + chunk, shape[axis])),
+                   *(slice(None),) * (len(shape) - axis - 1))
+
+
+def fill_vals(sd, shape, ndim, out, factor_wealth=True, players=None, resource_dependency=None,
+              tile_bytes=DEFAULT_TILE_BYTES, max_dirty_tiles=DEFAULT_MAX_DIRTY_TILES):
+    """
+    Same as `produce.get_vals(..., out=out)`, but the valuations are written into `out` tile by tile.
+    If `out` is memory mapped, it is flushed every `max_dirty_tiles` tiles, so no more than that number
+    of tiles is held in memory. Yields identical results to `produce.get_vals()`.
+    """
+    if isinstance(shape, int):
+        shape = (shape,)
+    val_slices, vals = lazy.get_vals(sd, shape, ndim, factor_wealth=factor_wealth, players=players,
+                                     resource_dependency=resource_dependency, dtype=out.dtype)
+    if out.shape != vals.shape:
+        raise ValueError(f"Output buffer must be of shape {vals.shape}.")
+
+    flush = getattr(out, 'flush', None)
+    dirty = 0
+    for p in range(len(vals)):
+        for box in iter_tiles(shape, out.itemsize, tile_bytes):
+            out[(p, *box)] = vals[(slice(p, p + 1), *box)][0]
+            dirty += 1
+            if flush is not None and dirty >= max_dirty_tiles:
+                flush()
+                dirty = 0
+
+    if flush is not None:
+        flush()
+    return val_slices, out
@@ -0,0 +1,196 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+from jointfunc_vcg.data import produce, tiled
+
+"""
+A content addressed, on-disk, cache of valuation tensors.
+Each entry is keyed by the inputs of `produce.get_vals()` and is stored as a `.npy` file of the valuations
+block (opened with `np.memmap` on a hit) and a `.npz` file of the slices.
+The cache size is capped, and the least recently used entries are evicted when it is exceeded.
+"""
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.environ.get('JOINTFUNC_VCG_CACHE_DIR',
+                                   os.path.join(tempfile.gettempdir(), 'jointfunc-vcg-vals-cache'))
+DEFAULT_MAX_BYTES = int(os.environ.get('JOINTFUNC_VCG_CACHE_MAX_BYTES', 16 * 2 ** 30))
+
+VALS_SUFFIX = '-vals.npy'
+SLICES_SUFFIX = '-slices.npz'
+
+
+def get_vals_key(sd, shape, ndim, factor_wealth=True, players=None, resource_dependency=None, dtype=None):
+    """ Returns a key that identifies the output of `produce.get_vals()` with these inputs """
+    if isinstance(shape, int):
+        shape = (shape,)
+    if resource_dependency is None:
+        resource_dependency = 'multiply'
+    if players is None:
+        players = range(sd.n)
+
+    dep = None
+    if resource_dependency.lower() not in produce.resource_dependency_func_options:
+        k = f'resource_dependency_{resource_dependency}'
+        if k in sd.data:
+            # Serialized as (action, i0, i1), as before the compact trees, to keep the existing keys
+            dep = [[(a, i0, i1) for a, (i0, i1) in produce.get_dependency_edges(sd.data[k][p])] for p in players]
+
+    h = hashlib.sha1()
+    h.update(json.dumps({
+        'version': CACHE_VERSION,
+        'shape': [int(s) for s in shape],
+        'ndim': int(ndim),
+        'factor-wealth': bool(factor_wealth),
+        'dtype': np.dtype(float if dtype is None else dtype).str,
+        'players': [int(p) for p in players],
+        'resource-dependency': resource_dependency.lower(),
+        'dependency-tree': dep,
+        'concave': bool(sd.meta['valuation'].get('concave', False)),
+        'local-maximum-limit': sd.meta['valuation'].get('local-maximum-limit', None),
+        'val-xy': produce.get_item_val_xy_digest(sd),
+    }, sort_keys=True).encode())
+    h.update(np.ascontiguousarray(sd.dist_data['wealth'], dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def get_entry_paths(cache_dir, key):
+    return os.path.join(cache_dir, key + VALS_SUFFIX), os.path.join(cache_dir, key + SLICES_SUFFIX)
+
+
+def load_entry(cache_dir, key):
+    """ Returns the cached (val_slices, vals) of a key, or None if it is not cached """
+    vals_path, slices_path = get_entry_paths(cache_dir, key)
+    try:
+        with np.load(slices_path) as f:
+            per_dim = [f['d%d' % d] for d in range(len(f.files))]
+        vals = np.load(vals_path, mmap_mode='r')
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+
+    for p in (vals_path, slices_path):
+        try:
+            os.utime(p)
+        except FileNotFoundError:
+            pass
+    return produce.stack_vals_slices(per_dim), vals
+
+
+def store_entry(cache_dir, key, sd, shape, ndim, players=None, dtype=None, tile_bytes=None, **kwargs):
+    """
+    Produces the valuations directly into a new cache entry, and returns it (memory mapped).
+    If `tile_bytes` is set, the valuations are produced tile by tile (see `tiled.fill_vals()`),
+    so the entry may be larger than the memory.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    if isinstance(shape, int):
+        shape = (shape,)
+    n = sd.n if players is None else len(players)
+
+    vals_path, slices_path = get_entry_paths(cache_dir, key)
+    fd, tmp_vals_path = tempfile.mkstemp(prefix='tmp-', suffix=VALS_SUFFIX, dir=cache_dir)
+    os.close(fd)
+    tmp_slices_path = None
+    try:
+        out = np.lib.format.open_memmap(tmp_vals_path, mode='w+', dtype=float if dtype is None else dtype,
+                                        shape=(n, *shape))
+        if tile_bytes is None:
+            val_slices, _ = produce.get_vals(sd, shape, ndim, players=players, out=out, **kwargs)
+        else:
+            val_slices, _ = tiled.fill_vals(sd, shape, ndim, out, players=players, tile_bytes=tile_bytes, **kwargs)
+        out.flush()
+        del out
+
+        per_dim = produce.unstack_vals_slices(val_slices)
+        fd, tmp_slices_path = tempfile.mkstemp(prefix='tmp-', suffix=SLICES_SUFFIX, dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **{'d%d' % d: v for d, v in enumerate(per_dim)})
+
+        # The slices are renamed last, so a partially written entry is never loaded
+        os.replace(tmp_vals_path, vals_path)
+        os.replace(tmp_slices_path, slices_path)
+    finally:
+        for p in (tmp_vals_path, tmp_slices_path):
+            if p is not None and os.path.exists(p):
+                os.remove(p)
+
+    return val_slices, np.load(vals_path, mmap_mode='r')
+
+
+def evict(cache_dir=None, max_bytes=None, keep=()):
+    """ Removes the least recently used entries until the cache size is at most `max_bytes` """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    if max_bytes is None:
+        max_bytes = DEFAULT_MAX_BYTES
+
+    entries = {}
+    try:
+        files = os.listdir(cache_dir)
+    except FileNotFoundError:
+        return
+    for fname in files:
+        for suffix in (VALS_SUFFIX, SLICES_SUFFIX):
+            if fname.endswith(suffix) and not fname.startswith('tmp-'):
+                key = fname[:-len(suffix)]
+                try:
+                    st = os.stat(os.path.join(cache_dir, fname))
+                except FileNotFoundError:
+                    continue
+                size, mtime = entries.get(key, (0, 0))
+                entries[key] = size + st.st_size, max(mtime, st.st_mtime)
+
+    total = sum(size for size, _ in entries.values())
+    for key, (size, _) in sorted(entries.items(), key=lambda e: e[1][1]):
+        if total <= max_bytes:
+            break
+        if key in keep:
+            continue
+        for p in get_entry_paths(cache_dir, key):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def clear(cache_dir=None):
+    evict(cache_dir, max_bytes=0)
+
+
+def get_vals(sd, shape, ndim, factor_wealth=True, players=None, resource_dependency=None, dtype=None,
+             cache_dir=None, max_bytes=None, tile_bytes=None):
+    """
+    Same as `produce.get_vals(..., as_block=True)`, but the result is cached on disk.
+    The valuations are returned as a read-only memory mapped block.
+    Set `tile_bytes` to produce valuations that do not fit in the memory (see `store_entry()`).
+    """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    key = get_vals_key(sd, shape, ndim, factor_wealth, players, resource_dependency, dtype)
+    ret = load_entry(cache_dir, key)
+    if ret is None:
+        ret = store_entry(cache_dir, key, sd, shape, ndim, players=players, dtype=dtype, tile_bytes=tile_bytes,
+                          factor_wealth=factor_wealth, resource_dependency=resource_dependency)
+        evict(cache_dir, max_bytes, keep=(key,))
+    return ret
@@ -0,0 +1,234 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import time
+import tempfile
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+from jointfunc_vcg.data import produce, vals_cache
+
+"""
+Shares the valuations of a dataset item between the processes of a batch.
+The first process that asks for a (dataset item, shape, dependency) combination publishes its
+valuations to a shared memory segment. Any other process attaches to that segment without copying.
+
+Segments published within a scope (see `create_scope()`) are unlinked by `cleanup_scope()`.
+A segment is also unlinked by the publisher's resource tracker when the processes that use that tracker exit
+(attached processes never register the segments), so segments do not outlive a crashed batch. A process that finds the segment unlinked, failed, or abandoned
+by a publisher that died while filling it, produces its valuations locally.
+"""
+
+SEGMENT_PREFIX = 'jfvcg-'
+SCOPE_SEGMENTS_FILE = 'segments'
+HEADER_SIZE = 64
+
+STATE_FILLING = 0
+STATE_READY = 1
+STATE_FAILED = 2
+
+# The segments this process is mapped to (name -> SharedMemory)
+mapped_segments = {}
+
+
+def create_scope():
+    """ Returns a new scope (a directory) that records the segments that were published within it """
+    return tempfile.mkdtemp(prefix='jointfunc-vcg-shm-')
+
+
+def register_segment(scope, name):
+    with open(os.path.join(scope, SCOPE_SEGMENTS_FILE), 'a') as f:
+        f.write(name + '\n')
+
+
+def open_segment(name):
+    """ Attaches to a segment. Only the publisher should unlink the segment when it exits. """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        pass
+    # Before python 3.13, attaching also registers the segment with the resource tracker. The tracker may be
+    # shared with the publisher (spawn/forkserver, or fork after the tracker started), so unregistering it here
+    # would also drop the publisher's registration. Thus, the segment is not registered in the first place.
+    register = resource_tracker.register
+    resource_tracker.register = lambda *_args: None
+    try:
+        return shared_memory.SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+
+def unlink_segment(name):
+    try:
+        # Tracked, so `unlink()` unregisters exactly what was registered here
+        shm = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def cleanup_scope(scope):
+    """ Unlinks all the segments that were published within the scope. Attached processes keep their map. """
+    fpath = os.path.join(scope, SCOPE_SEGMENTS_FILE)
+    try:
+        with open(fpath) as f:
+            names = set(f.read().split())
+    except FileNotFoundError:
+        names = ()
+    for name in names:
+        unlink_segment(name)
+
+    if os.path.exists(fpath):
+        os.remove(fpath)
+    os.rmdir(scope)
+
+
+def release(keep=()):
+    """ Unmaps the segments that are no longer used by this process """
+    for name, shm in list(mapped_segments.items()):
+        if name in keep:
+            continue
+        try:
+            shm.close()
+        except BufferError:
+            # Some arrays that are mapped on this segment are still alive
+            continue
+        del mapped_segments[name]
+
+
+def get_layout(n, shape, dtype):
+    """ Returns the offset and shape of the valuations and each dimension's slices in the segment """
+    layout = []
+    offset = HEADER_SIZE
+    for s in ((n, *shape), *((n, sz) for sz in shape)):
+        layout.append((offset, s))
+        offset += int(np.prod(s)) * np.dtype(dtype).itemsize
+    return layout, offset
+
+
+def map_arrays(shm, n, shape, dtype):
+    """ Maps the header (the state and the publisher's pid), the valuations and the slices of the segment """
+    layout, _ = get_layout(n, shape, dtype)
+    state = np.ndarray((2,), dtype=np.uint64, buffer=shm.buf)
+    vals, *per_dim = [np.ndarray(s, dtype=dtype, buffer=shm.buf, offset=o) for o, s in layout]
+    return state, vals, per_dim
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def attach(name, n, shape, dtype, timeout):
+    """
+    Attaches to an existing segment, and waits until its publisher is done filling it.
+    Raises RuntimeError if the publisher failed or died while filling it.
+    """
+    shm = mapped_segments.get(name, None)
+    if shm is None:
+        shm = open_segment(name)
+        mapped_segments[name] = shm
+
+    state, vals, per_dim = map_arrays(shm, n, shape, dtype)
+    end = time.time() + timeout
+    while state[0] == STATE_FILLING:
+        # The pid is 0 until the publisher wrote it
+        if state[1] != 0 and not is_alive(int(state[1])):
+            raise RuntimeError(f"The publisher of the shared valuations died: {name}.")
+        if time.time() > end:
+            raise TimeoutError(f"Timed out waiting for shared valuations: {name}.")
+        time.sleep(0.01)
+    if state[0] != STATE_READY:
+        raise RuntimeError(f"Failed to publish shared valuations: {name}.")
+
+    vals.flags.writeable = False
+    return produce.stack_vals_slices(per_dim), vals
+
+
+def publish(name, sd, shape, ndim, players, dtype, scope, **kwargs):
+    """ Creates a segment and produces the valuations directly into it """
+    n = sd.n if players is None else len(players)
+    _, size = get_layout(n, shape, dtype)
+    shm = shared_memory.SharedMemory(name, create=True, size=size)
+    if scope is not None:
+        register_segment(scope, name)
+
+    state, vals, per_dim = map_arrays(shm, n, shape, dtype)
+    state[1] = os.getpid()
+    try:
+        val_slices, _ = produce.get_vals(sd, shape, ndim, players=players, out=vals, **kwargs)
+        for src, dst in zip(produce.unstack_vals_slices(val_slices), per_dim):
+            dst[...] = src
+    except BaseException:
+        state[0] = STATE_FAILED
+        del state, vals, per_dim
+        try:
+            shm.close()
+        except BufferError:
+            pass
+        shm.unlink()
+        raise
+
+    state[0] = STATE_READY
+    mapped_segments[name] = shm
+    return produce.stack_vals_slices(per_dim), vals
+
+
+def get_vals(sd, shape, ndim, factor_wealth=True, players=None, resource_dependency=None, dtype=None,
+             scope=None, timeout=3600):
+    """
+    Same as `produce.get_vals(..., as_block=True)`, but the result is shared with all the processes
+    that ask for the same valuations.
+    The segment stays mapped in this process until `release()` is called after its arrays are gone
+    (it is called on each `get_vals()`).
+    """
+    if isinstance(shape, int):
+        shape = (shape,)
+    if dtype is None:
+        dtype = float
+    key = vals_cache.get_vals_key(sd, shape, ndim, factor_wealth, players, resource_dependency, dtype)
+    name = SEGMENT_PREFIX + key[:24]
+    n = sd.n if players is None else len(players)
+    release(keep=(name,))
+
+    if name not in mapped_segments:
+        try:
+            return publish(name, sd, shape, ndim, players, dtype, scope, factor_wealth=factor_wealth,
+                           resource_dependency=resource_dependency)
+        except FileExistsError:
+            pass
+
+    try:
+        return attach(name, n, shape, dtype, timeout)
+    except (FileNotFoundError, ValueError, RuntimeError, TimeoutError):
+        # The segment was unlinked, is not sized yet (ValueError), or its publisher failed, died or is stuck: produce the valuations locally
+        shm = mapped_segments.pop(name, None)
+        if shm is not None:
+            try:
+                shm.close()
+            except BufferError:
+                pass
+        return produce.get_vals(sd, shape, ndim, factor_wealth=factor_wealth, players=players,
+                                resource_dependency=resource_dependency, as_block=True, dtype=dtype)
@@ -16,59 +16,165 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import shutil
+import tempfile
+import collections
+
 from cloudsim.dataset import DataSet
-from jointfunc_vcg.exp import batch, workers, param
+from jointfunc_vcg.data import vals_shm
+from jointfunc_vcg.exp import batch, workers, param, profiling, schedule, completed, workqueue
 
 
 #########################################################################################################
 # Generic Experiments Function
 #########################################################################################################
 
+def get_job_items(ds_obj: DataSet, sim_kwargs):
+    """ Returns the indices of the dataset items that a job runs on """
+    interval = sim_kwargs.get('datasets_interval', None)
+    if interval is not None:
+        return range(*interval)
+    return list(ds_obj.get_data_index_list())
+
+
 def start(ds_obj: DataSet, worker_func, exp_type, exp_param=None, exp_prefix=None, exp_suffix=None,
-          sim_kwargs=None, **kwargs):
+          sim_kwargs=None, shared_vals=False, profile=None, profiles_dir=None, index_path=None, dry_run=False,
+          clear_cache=True, **kwargs):
+    """
+    If `shared_vals` is set, jobs that run in parallel on the same dataset item share their valuations
+    via shared memory (see `data.vals_shm`). The segments are unlinked when the job finishes or fails.
+    If `profile` is set ('cprofile' or 'sampling'), each job runs under that profiler, and its profile is saved
+    under the experiment key (see `profiling.run_profiled()`).
+    If the index of completed experiments is used (see `completed.get_index_path()`), each job records its
+    completion in it. With `skip_existing`, a job that the index reports as done on all its items is skipped.
+    If `dry_run` is set, only returns the job's experiment key, worker and worker's arguments.
+    Unless `clear_cache` is unset, the dataset's loaded items are dropped when the job finishes.
+    """
     if sim_kwargs is None:
         sim_kwargs = {}
     sim_key = param.get_experiment_name(exp_type, exp_param, exp_prefix, exp_suffix)
-    ret = ds_obj.create_job(sim_key, worker_func, kwargs=kwargs, **sim_kwargs)
-    ds_obj.clear_cache()
+    if dry_run:
+        return {'exp-key': sim_key, 'worker': worker_func, 'kwargs': kwargs}
+    ds_name = ds_obj.meta['name']
+    index_path = completed.get_index_path(index_path)
+    if index_path is not None and sim_kwargs.get('skip_existing', False):
+        if completed.is_done(ds_name, sim_key, get_job_items(ds_obj, sim_kwargs), index_path):
+            return None
+    if profile is not None:
+        worker_func = profiling.get_profiled_worker(worker_func, profile, ds_name, sim_key, profiles_dir)
+    if index_path is not None:
+        worker_func = completed.get_indexed_worker(worker_func, ds_name, sim_key, index_path)
+
+    scope = None
+    if shared_vals:
+        scope = vals_shm.create_scope()
+        kwargs['vals_shm_scope'] = scope
+    try:
+        ret = ds_obj.create_job(sim_key, worker_func, kwargs=kwargs, **sim_kwargs)
+    finally:
+        if scope is not None:
+            vals_shm.cleanup_scope(scope)
+    if clear_cache:
+        ds_obj.clear_cache()
     return ret
 
 
+def get_vals_key(kwargs):
+    """ Returns the parameters of the valuations of an experiment's job """
+    return repr([kwargs.get(k, None) for k in ('sz', 'ndim', 'resource_dependency', 'dtype', 'vals_tile_bytes')])
+
+
+def start_sequence(ds_obj: DataSet, jobs, dry_run=False, share_vals=True):
+    """
+    Runs several experiments, each a (function, kwargs) of the functions below, one after the other.
+    Each runs as its own job, under its own experiment key, but the dataset's loaded items are kept until the last
+    one finishes. If `share_vals` is set, the jobs that use the same valuations, and do not set `vals_cache_dir`
+    or `shared_vals`, share them through a temporary on-disk cache (see `data.vals_cache`), so each item's
+    valuations are produced once.
+    Returns the jobs' results (or their dry runs, if `dry_run` is set).
+    """
+    if dry_run:
+        return [func(ds_obj, dry_run=True, **kwargs) for func, kwargs in jobs]
+    vals_count = collections.Counter(get_vals_key(kwargs) for _, kwargs in jobs) if share_vals else {}
+    vals_cache_dir = tempfile.mkdtemp(prefix='jointfunc-vcg-vals-') if max(vals_count.values(), default=0) > 1 \
+        else None
+    try:
+        ret = []
+        for func, kwargs in jobs:
+            if vals_count.get(get_vals_key(kwargs), 0) > 1 and kwargs.get('vals_cache_dir', None) is None and \
+                    not kwargs.get('shared_vals', False):
+                kwargs = dict(kwargs, vals_cache_dir=vals_cache_dir)
+            ret.append(func(ds_obj, clear_cache=False, **kwargs))
+        return ret
+    finally:
+        ds_obj.clear_cache()
+        if vals_cache_dir is not None:
+            shutil.rmtree(vals_cache_dir, ignore_errors=True)
+
+
 #########################################################################################################
 # Specific Experiments Functions
 #########################################################################################################
 
 def maille_tuffin(ds_obj: DataSet, exp_type='maille-tuffin', ndim=1, sz=2 ** 10,
-                  resource_dependency='complementary',
+                  resource_dependency='complementary', dtype=None,
                   exp_prefix=None, sim_kwargs=None, **kwargs):
     return start(ds_obj, workers.maille_tuffin,
                  exp_type=exp_type,
                  exp_param=(ndim, sz),
                  exp_prefix=exp_prefix,
-                 exp_suffix=resource_dependency,
+                 exp_suffix=param.get_experiment_suffix(resource_dependency, dtype),
                  sim_kwargs=sim_kwargs,
-                 sz=sz, ndim=ndim, resource_dependency=resource_dependency, **kwargs)
+                 sz=sz, ndim=ndim, resource_dependency=resource_dependency, dtype=dtype, **kwargs)
 
 
 def joint_val(ds_obj: DataSet, exp_type='joint-val', join_method=3, ndim=1, sz=2 ** 10,
-              resource_dependency='complementary',
+              resource_dependency='complementary', dtype=None,
               exp_prefix=None, sim_kwargs=None, **kwargs):
     return start(ds_obj, workers.joint_val,
                  exp_type=exp_type,
                  exp_param=(join_method, ndim, sz),
                  exp_prefix=exp_prefix,
-                 exp_suffix=resource_dependency,
+                 exp_suffix=param.get_experiment_suffix(resource_dependency, dtype),
                  sim_kwargs=sim_kwargs,
-                 join_method=join_method, sz=sz, ndim=ndim, resource_dependency=resource_dependency, **kwargs)
+                 join_method=join_method, sz=sz, ndim=ndim, resource_dependency=resource_dependency, dtype=dtype,
+                 **kwargs)
+
+
+def joint_val_sweep(ds_obj: DataSet, exp_type='joint-val', join_methods=(3,),
+                    join_chunk_sizes=(param.DEFAULT_JOIN_CHUNK_SIZE,), join_flags_options=(None,), ndim=1, sz=2 ** 10,
+                    exp_prefix=None, dry_run=False, **kwargs):
+    """
+    Runs every combination of the join methods, chunk sizes and flags of a (ndim, sz) point (see `joint_val()`)
+    on the same valuations (see `start_sequence()`). Each configuration is stored under its own experiment key.
+    A configuration with a non-default chunk size or flags is distinguished by its key's prefix
+    (see `param.get_join_config_prefix()`).
+    """
+    jobs = [(joint_val, dict(kwargs, exp_type=exp_type, join_method=m, join_chunk_size=c, join_flags=f,
+                             ndim=ndim, sz=sz, exp_prefix=param.get_join_config_prefix(c, f, exp_prefix)))
+            for m in join_methods for c in join_chunk_sizes for f in join_flags_options]
+    return start_sequence(ds_obj, jobs, dry_run=dry_run)
 
 
 def test_joint_val_ds_build_time(ds_obj: DataSet, exp_type='test-buildtime', join_method=3, sz=2 ** 10, ndim=1,
-                                 resource_dependency='complementary',
+                                 resource_dependency='complementary', dtype=None,
                                  exp_prefix=None, sim_kwargs=None, **kwargs):
     return start(ds_obj, workers.test_joint_val_ds_build_time,
                  exp_type=exp_type,
                  exp_param=(join_method, ndim, sz),
                  exp_prefix=exp_prefix,
-                 exp_suffix=resource_dependency,
+                 exp_suffix=param.get_experiment_suffix(resource_dependency, dtype),
                  sim_kwargs=sim_kwargs,
-                 join_method=join_method, sz=sz, ndim=ndim, resource_dependency=resource_dependency, **kwargs)
+                 join_method=join_method, sz=sz, ndim=ndim, resource_dependency=resource_dependency, dtype=dtype,
+                 **kwargs)
+
+
+def coalesced(ds_obj: DataSet, jobs, sim_kwargs=None, index_path=None, dry_run=False, **kwargs):
+    """
+    Runs several experiments, each a (function, kwargs) of the functions above, as a single batch job that loads
+    each dataset item once (see `start_sequence()`). Each experiment is stored under its own key.
+    The experiments are small (see `schedule.RuntimeScheduler.coalesce()`), so they do not share their valuations
+    through the on-disk cache: producing them is cheaper than writing and reading them.
+    """
+    return start_sequence(ds_obj, [(func, dict(kwargs, sim_kwargs=sim_kwargs, index_path=index_path, **func_kwargs))
+                                   for func, func_kwargs in jobs], dry_run=dry_run, share_vals=False)
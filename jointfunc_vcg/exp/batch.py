@@ -18,43 +18,93 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from cloudsim import dataset, job
 from jointfunc_vcg import exp, data
+from jointfunc_vcg.exp import schedule, completed
 import numpy as np
 import pandas as pd
 
 
+def get_pending_jobs(jobs):
+    """
+    Drops the jobs with `skip_existing` that the index of completed experiments (see `completed`) reports as done
+    on all their items (for a job of several experiments, e.g., `exp.joint_val_sweep()`, all of them).
+    The index is queried once per dataset.
+    """
+    done = {}
+    ret = []
+    for func, args, kwargs in jobs:
+        sim_kwargs = kwargs.get('sim_kwargs', None) or {}
+        index_path = completed.get_index_path(kwargs.get('index_path', None))
+        if index_path is None or not sim_kwargs.get('skip_existing', False):
+            ret.append((func, args, kwargs))
+            continue
+        ds_obj = args[0]
+        ds_key = ds_obj.meta['name'], index_path
+        if ds_key not in done:
+            entries = completed.query(ds_obj.meta['name'], status=completed.STATUS_DONE, index_path=index_path)
+            done[ds_key] = entries.groupby('exp_key')['item'].agg(set).to_dict()
+        points = func(*args, dry_run=True, **kwargs)
+        if isinstance(points, dict):
+            points = [points]
+        items = set(exp.get_job_items(ds_obj, sim_kwargs))
+        if any(not items <= done[ds_key].get(p['exp-key'], set()) for p in points):
+            ret.append((func, args, kwargs))
+    return ret
+
+
 def maille_tuffin(ds_obj: dataset.DataSet, exp_type='maille-tuffin', sizes=(2**10,), dims=(1,),
-                  resource_dependencies=('complementary', 'substitute', 'multiply'), **kwargs):
+                  resource_dependencies=('complementary', 'substitute', 'multiply'), scheduler=None, **kwargs):
+    jobs = []
     for d in dims:
         for sz in sizes:
             for r in resource_dependencies:
-                job.add_batch_job(exp.maille_tuffin, ds_obj,
-                                  exp_type=exp_type,
-                                  sz=sz, ndim=d, resource_dependency=r, **kwargs)
+                jobs.append((exp.maille_tuffin, (ds_obj,),
+                             dict(exp_type=exp_type,
+                                  sz=sz, ndim=d, resource_dependency=r, **kwargs)))
+    return schedule.add_jobs(get_pending_jobs(jobs), scheduler)
 
 
 def joint_val(ds_obj: dataset.DataSet, exp_type='joint-val', join_methods=(0,), sizes=(2**10,), dims=(1,),
-              resource_dependencies=('complementary', 'substitute', 'multiply'), **kwargs):
+              resource_dependencies=('complementary', 'substitute', 'multiply'), scheduler=None, **kwargs):
+    jobs = []
     for m in join_methods:
         for d in dims:
             for sz in sizes:
                 for r in resource_dependencies:
-                    job.add_batch_job(exp.joint_val, ds_obj,
-                                      exp_type=exp_type,
+                    jobs.append((exp.joint_val, (ds_obj,),
+                                 dict(exp_type=exp_type,
                                       join_method=m, sz=sz, ndim=d,
-                                      resource_dependency=r, **kwargs)
+                                      resource_dependency=r, **kwargs)))
+    return schedule.add_jobs(get_pending_jobs(jobs), scheduler)
+
+
+def joint_val_sweep(ds_obj: dataset.DataSet, exp_type='joint-val', join_methods=(0,), join_chunk_sizes=(8,),
+                    join_flags_options=(None,), sizes=(2**10,), dims=(1,),
+                    resource_dependencies=('complementary', 'substitute', 'multiply'), scheduler=None, **kwargs):
+    jobs = []
+    for d in dims:
+        for sz in sizes:
+            for r in resource_dependencies:
+                jobs.append((exp.joint_val_sweep, (ds_obj,),
+                             dict(exp_type=exp_type,
+                                  join_methods=join_methods, join_chunk_sizes=join_chunk_sizes,
+                                  join_flags_options=join_flags_options,
+                                  sz=sz, ndim=d, resource_dependency=r, **kwargs)))
+    return schedule.add_jobs(get_pending_jobs(jobs), scheduler)
 
 
 def ds_build_time(ds_obj: dataset.DataSet, exp_type='test-buildtime',
                   join_methods=(3,), sizes=(2**10,), dims=(1,),
-                  resource_dependencies=('complementary', 'substitute', 'multiply'), **kwargs):
+                  resource_dependencies=('complementary', 'substitute', 'multiply'), scheduler=None, **kwargs):
+    jobs = []
     for m in join_methods:
         for d in dims:
             for sz in sizes:
                 for r in resource_dependencies:
-                    job.add_batch_job(exp.test_joint_val_ds_build_time, ds_obj,
-                                      exp_type=exp_type,
+                    jobs.append((exp.test_joint_val_ds_build_time, (ds_obj,),
+                                 dict(exp_type=exp_type,
                                       join_method=m, sz=sz, ndim=d,
-                                      resource_dependency=r, **kwargs)
+                                      resource_dependency=r, **kwargs)))
+    return schedule.add_jobs(get_pending_jobs(jobs), scheduler)
 
 
 def get_batch_jobs_list():
@@ -0,0 +1,165 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import time
+import sqlite3
+import functools
+import contextlib
+import pandas as pd
+
+"""
+An index of the completed experiments (a SQLite database), so the finished points of a sweep are found
+without scanning the datasets' result files.
+Each job records its (dataset, item index, experiment key) with its status ('done' or 'failed'), its runtime,
+and the path of its artifacts that are stored outside of the dataset (e.g., its profile), if any.
+The experiment keys (see `param.get_experiment_name()`) are stored joined by '/'. A slice in a queried key
+matches any value.
+The index is opt-in: it is only used if its path is given (`index_path`), or set in the JOINTFUNC_VCG_INDEX_PATH
+environment variable, e.g., to a file alongside the datasets.
+"""
+
+DEFAULT_INDEX_PATH = os.environ.get('JOINTFUNC_VCG_INDEX_PATH', None)
+COLUMNS = 'dataset', 'item', 'exp_key', 'status', 'runtime', 'result_path', 'updated'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+CONNECT_TIMEOUT = 60
+
+
+def get_index_path(index_path=None):
+    """ Returns the path of the index, or None if it is not used (`index_path=False`, or no default path) """
+    if index_path is False:
+        return None
+    if index_path is None:
+        return DEFAULT_INDEX_PATH
+    return index_path
+
+
+@contextlib.contextmanager
+def connect(index_path=None):
+    index_path = get_index_path(index_path)
+    if index_path is None:
+        raise ValueError("No index of completed experiments. Set its path or JOINTFUNC_VCG_INDEX_PATH.")
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    conn = sqlite3.connect(index_path, timeout=CONNECT_TIMEOUT)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS experiments ("
+                     "dataset TEXT, item INTEGER, exp_key TEXT, status TEXT, runtime REAL, result_path TEXT, "
+                     "updated REAL, PRIMARY KEY (dataset, exp_key, item))")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def encode_key(exp_key):
+    return "/".join(exp_key)
+
+
+def get_key_condition(exp_key, prefix=False):
+    """
+    Returns the SQL condition (and its arguments) that matches the key.
+    If `prefix` is set, it also matches the keys that extend it (e.g., ('joint-val', '3-1-1024') matches
+    'joint-val/3-1-1024/complementary'), as the dataset's results are read.
+    """
+    pattern = "/".join('*' if isinstance(k, slice) else k.replace('[', '[[]').replace('*', '[*]').replace('?', '[?]')
+                       for k in exp_key)
+    if not any(isinstance(k, slice) for k in exp_key):
+        cond, args = "exp_key = ?", [encode_key(exp_key)]
+    else:
+        cond, args = "exp_key GLOB ?", [pattern]
+    if prefix:
+        cond, args = "(%s OR exp_key GLOB ?)" % cond, args + [pattern + "/*"]
+    return cond, args
+
+
+def record(ds_name, index, exp_key, status, runtime=None, result_path=None, index_path=None):
+    with connect(index_path) as conn:
+        conn.execute("INSERT OR REPLACE INTO experiments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (ds_name, int(index), encode_key(exp_key), status, runtime, result_path, time.time()))
+
+
+def run_indexed(worker_func, ds_name, exp_key, index_path, ds_obj, index, sd, **kwargs):
+    """ Runs a worker, and records its completion (or failure) in the index """
+    start = time.time()
+    try:
+        ret = worker_func(ds_obj, index, sd, **kwargs)
+    except BaseException:
+        record(ds_name, index, exp_key, STATUS_FAILED, time.time() - start, index_path=index_path)
+        raise
+    result_path = ret.get('profile-artifact', None) if isinstance(ret, dict) else None
+    record(ds_name, index, exp_key, STATUS_DONE, time.time() - start, result_path, index_path)
+    return ret
+
+
+def get_indexed_worker(worker_func, ds_name, exp_key, index_path=None):
+    """ Returns a (picklable) worker that records the completion of `worker_func` in the index """
+    ret = functools.partial(run_indexed, worker_func, ds_name, exp_key, index_path)
+    return functools.update_wrapper(ret, worker_func)
+
+
+def query(ds_name=None, exp_key=None, status=None, index_path=None, prefix=False):
+    """
+    Returns the index entries that match the dataset, the key (see `get_key_condition()`, also as a `prefix`)
+    and the status
+    """
+    conditions, args = [], []
+    if ds_name is not None:
+        conditions.append("dataset = ?")
+        args.append(ds_name)
+    if exp_key is not None:
+        cond, cond_args = get_key_condition(exp_key, prefix)
+        conditions.append(cond)
+        args.extend(cond_args)
+    if status is not None:
+        conditions.append("status = ?")
+        args.append(status)
+    sql = "SELECT %s FROM experiments" % ", ".join(COLUMNS)
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    with connect(index_path) as conn:
+        rows = conn.execute(sql + " ORDER BY dataset, exp_key, item", args).fetchall()
+    ret = pd.DataFrame(rows, columns=COLUMNS)
+    ret['exp_key'] = [tuple(k.split("/")) for k in ret['exp_key']]
+    return ret
+
+
+def get_done_items(ds_name, exp_key, index_path=None):
+    """ Returns the indices of the items on which the experiment is done """
+    cond, args = get_key_condition(exp_key)
+    with connect(index_path) as conn:
+        rows = conn.execute("SELECT item FROM experiments WHERE dataset = ? AND status = ? AND " + cond,
+                            [ds_name, STATUS_DONE, *args]).fetchall()
+    return {r[0] for r in rows}
+
+
+def is_done(ds_name, exp_key, items, index_path=None):
+    """ Returns True if the experiment is done on all the items """
+    return set(items) <= get_done_items(ds_name, exp_key, index_path)
+
+
+def forget(ds_name, exp_key=None, index_path=None):
+    """ Removes the entries of the dataset (and the key) from the index, e.g., after its results were deleted """
+    conditions, args = ["dataset = ?"], [ds_name]
+    if exp_key is not None:
+        cond, cond_args = get_key_condition(exp_key)
+        conditions.append(cond)
+        args.extend(cond_args)
+    with connect(index_path) as conn:
+        conn.execute("DELETE FROM experiments WHERE " + " AND ".join(conditions), args)
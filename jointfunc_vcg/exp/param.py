@@ -21,6 +21,8 @@ import numpy as np
 
 from cloudsim import dataset
 
+DEFAULT_JOIN_CHUNK_SIZE = 8
+
 
 def get_experiment_name(exp_type, exp_param=None, exp_prefix=None, exp_suffix=None):
     if type(exp_param) in (tuple, list):
@@ -39,6 +41,28 @@ def get_experiment_name(exp_type, exp_param=None, exp_prefix=None, exp_suffix=No
     return tuple(key_set)
 
 
+def get_experiment_suffix(resource_dependency, dtype=None):
+    """ The default (float64) experiments are named only by their resource dependency """
+    if dtype is None or np.dtype(dtype) == np.float64:
+        return resource_dependency
+    return "%s-%s" % (resource_dependency, np.dtype(dtype).name)
+
+
+def get_join_config_prefix(join_chunk_size=DEFAULT_JOIN_CHUNK_SIZE, join_flags=None, exp_prefix=None):
+    """
+    Returns the experiment prefix of a joint valuation configuration (see `exp.joint_val_sweep()`).
+    The default configuration keeps `exp_prefix`, so it is named as by `exp.joint_val()`.
+    """
+    key = [] if exp_prefix is None else [exp_prefix]
+    if join_chunk_size != DEFAULT_JOIN_CHUNK_SIZE:
+        key.append("chunk%s" % join_chunk_size)
+    if join_flags:
+        key.append("+".join(join_flags))
+    if not key:
+        return None
+    return "-".join(map(str, key))
+
+
 def get_shape_for_gridpoints(sz, ndim):
     """ Finds a multidimensional, balanced, shape that have the closest number of gridpoints """
     t = int(float(sz)**(1/ndim))
@@ -0,0 +1,115 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import zlib
+import numpy as np
+
+"""
+Compacts the results of the workers before they are stored, according to a detail level:
+ - 'summary': only the scalar results and the 'input', 'stats', 'dtype-check' and 'profile' sections are kept.
+   The per-player arrays (e.g., 'allocations' and 'payments') are dropped.
+ - 'compressed': the arrays are also kept, encoded by `encode_array()` (integer arrays are stored in the
+   smallest sufficient integer dtype, boolean arrays stay boolean, and all arrays are zlib compressed).
+   Use `decode_arrays()` to read them.
+ - 'full' (default): the results are stored as they are.
+The 'n-chunks' input, which is always the shape minus one, is only stored in 'full'.
+"""
+
+DETAIL_LEVELS = 'summary', 'compressed', 'full'
+DEFAULT_DETAIL = 'full'
+
+SECTIONS = 'input', 'stats', 'dtype-check', 'profile'
+DERIVED_INPUT = 'n-chunks',
+
+ENCODING = 'zlib'
+
+
+def get_min_int_dtype(a):
+    """ Returns the smallest integer dtype that holds all the values of an integer array """
+    if a.size == 0:
+        return np.dtype(np.uint8)
+    lo, hi = a.min(), a.max()
+    for t in (np.uint8, np.uint16, np.uint32, np.uint64) if lo >= 0 else (np.int8, np.int16, np.int32, np.int64):
+        if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max:
+            return np.dtype(t)
+    return a.dtype
+
+
+def encode_array(a):
+    a = np.asarray(a)
+    if a.dtype.kind in 'iu':
+        a = a.astype(get_min_int_dtype(a), copy=False)
+    return {
+        'encoding': ENCODING,
+        'dtype': a.dtype.str,
+        'shape': a.shape,
+        'data': zlib.compress(np.ascontiguousarray(a).tobytes()),
+    }
+
+
+def is_encoded_array(v):
+    return isinstance(v, dict) and v.get('encoding', None) == ENCODING
+
+
+def decode_array(v):
+    """ Returns the array of an encoded array (see `encode_array()`), or the value itself if it is not encoded """
+    if not is_encoded_array(v):
+        return v
+    return np.frombuffer(zlib.decompress(v['data']), dtype=np.dtype(v['dtype'])).reshape(v['shape'])
+
+
+def decode_arrays(values):
+    """ Decodes all the encoded arrays in a nested structure of results (e.g., from `read_unified_results()`) """
+    if is_encoded_array(values):
+        return decode_array(values)
+    if isinstance(values, dict):
+        return {k: decode_arrays(v) for k, v in values.items()}
+    if isinstance(values, (list, tuple)) or (isinstance(values, np.ndarray) and values.dtype == object):
+        return [decode_arrays(v) for v in values]
+    return values
+
+
+def is_scalar(v):
+    return v is None or np.isscalar(v) or (isinstance(v, np.ndarray) and v.ndim == 0)
+
+
+def compact_result(ret, detail=DEFAULT_DETAIL):
+    """ Compacts the result of a worker according to the detail level (see `DETAIL_LEVELS`) """
+    if detail not in DETAIL_LEVELS:
+        raise ValueError(f"No such result detail level: {detail}. Options: {', '.join(DETAIL_LEVELS)}.")
+    if detail == 'full':
+        return ret
+
+    compact = {}
+    for k, v in ret.items():
+        if k == 'input':
+            compact[k] = {ik: iv for ik, iv in v.items() if ik not in DERIVED_INPUT}
+        elif k in SECTIONS:
+            compact[k] = v
+        elif isinstance(v, dict):
+            # A nested section of the result
+            compact[k] = compact_result(v, detail)
+        elif is_scalar(v):
+            compact[k] = v
+        elif detail == 'compressed':
+            try:
+                compact[k] = encode_array(v)
+            except ValueError:
+                # A ragged array
+                compact[k] = v
+    return compact
@@ -0,0 +1,214 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import sys
+import glob
+import time
+import pstats
+import cProfile
+import resource
+import functools
+import threading
+import contextlib
+import collections
+import tracemalloc
+
+DEFAULT_PROFILES_DIR = os.environ.get('JOINTFUNC_VCG_PROFILES_DIR',
+                                      os.path.join(os.path.expanduser('~'), '.cache', 'jointfunc-vcg', 'profiles'))
+PROFILE_SUFFIX = {
+    'cprofile': '.prof',
+    'sampling': '.folded',
+}
+DEFAULT_SAMPLING_INTERVAL = 0.005
+
+
+def reset_peak_rss():
+    """ Resets the peak RSS of the process (Linux only). Returns False if it is not supported. """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    """ Returns the peak RSS of the process in bytes (since the last `reset_peak_rss()`, if supported) """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class PhaseProfiler:
+    """
+    Records the wall time, CPU time and memory high-water marks of each phase of a worker:
+     - 'wall-time', 'cpu-time': in seconds
+     - 'peak-rss': the process's peak RSS in bytes during the phase (or since it started, if the peak
+       cannot be reset on this platform)
+     - 'tracemalloc-peak': the peak of the memory that was allocated during the phase (python and numpy)
+       in bytes, if `trace_malloc` is set. It is off by default: tracing slows down every allocation.
+    """
+    def __init__(self, trace_malloc=False):
+        self.trace_malloc = trace_malloc
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started_tracing = False
+        if self.trace_malloc:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            traced_start, _ = tracemalloc.get_traced_memory()
+        reset_peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            record = {
+                'wall-time': time.perf_counter() - wall_start,
+                'cpu-time': time.process_time() - cpu_start,
+                'peak-rss': get_peak_rss(),
+            }
+            if self.trace_malloc:
+                _, traced_peak = tracemalloc.get_traced_memory()
+                record['tracemalloc-peak'] = max(traced_peak - traced_start, 0)
+                if started_tracing:
+                    tracemalloc.stop()
+            self.phases[name] = record
+
+    def results(self):
+        return dict(self.phases)
+
+
+class SamplingProfiler:
+    """
+    A low overhead profiler that samples the stack of a thread every `interval` seconds.
+    The samples are saved in the folded stacks format (one 'outer;...;inner count' line per stack).
+    Code that holds the GIL (e.g., a C extension) is attributed to the python frame that called it,
+    but it may delay the samples that are taken while it runs.
+    """
+    def __init__(self, interval=DEFAULT_SAMPLING_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.thread_id = None
+        self.stop_event = threading.Event()
+        self.sampler = None
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id, None)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s:%d(%s)" % (code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.samples[tuple(reversed(stack))] += 1
+
+    def enable(self):
+        self.thread_id = threading.get_ident()
+        self.stop_event.clear()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def disable(self):
+        self.stop_event.set()
+        self.sampler.join()
+
+    def dump_stats(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write("%s %d\n" % (";".join(stack), count))
+
+
+def create_profiler(profile):
+    if profile == 'cprofile':
+        return cProfile.Profile()
+    if profile == 'sampling':
+        return SamplingProfiler()
+    raise ValueError(f"No such profiler: {profile}. Options: {', '.join(PROFILE_SUFFIX)}.")
+
+
+def get_profile_dir(ds_name, exp_key, profiles_dir=None):
+    """ Returns the directory of the profiles of an experiment. Slices in the key match any experiment. """
+    if profiles_dir is None:
+        profiles_dir = DEFAULT_PROFILES_DIR
+    return os.path.join(profiles_dir, ds_name, *('*' if isinstance(k, slice) else k for k in exp_key))
+
+
+def run_profiled(worker_func, profile, ds_name, exp_key, profiles_dir, ds_obj, index, sd, **kwargs):
+    """ Runs a worker under a profiler, and saves the profile of the job with its dataset index """
+    profiler = create_profiler(profile)
+    profiler.enable()
+    try:
+        ret = worker_func(ds_obj, index, sd, **kwargs)
+    finally:
+        profiler.disable()
+        profile_dir = get_profile_dir(ds_name, exp_key, profiles_dir)
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, '%s%s' % (index, PROFILE_SUFFIX[profile]))
+        profiler.dump_stats(path)
+
+    if isinstance(ret, dict):
+        ret['profile-artifact'] = path
+    return ret
+
+
+def get_profiled_worker(worker_func, profile, ds_name, exp_key, profiles_dir=None):
+    """ Returns a (picklable) worker that runs `worker_func` under the `profile` profiler """
+    create_profiler(profile)
+    ret = functools.partial(run_profiled, worker_func, profile, ds_name, exp_key, profiles_dir)
+    return functools.update_wrapper(ret, worker_func)
+
+
+def find_profiles(ds_name, exp_key, profiles_dir=None):
+    """ Returns the paths of all the profiles of the experiments that match the key, by profiler """
+    profile_dir = get_profile_dir(ds_name, exp_key, profiles_dir)
+    return {profile: sorted(glob.glob(os.path.join(profile_dir, '*' + suffix)))
+            for profile, suffix in PROFILE_SUFFIX.items()}
+
+
+def load_cprofile_stats(paths):
+    """ Returns the functions' stats, summed over the profiles, as {function: (calls, tottime, cumtime)} """
+    stats = pstats.Stats(*paths)
+    return {"%s:%d(%s)" % func: (nc, tt, ct) for func, (cc, nc, tt, ct, callers) in stats.stats.items()}
+
+
+def load_sampling_stats(paths):
+    """ Returns the functions' samples, summed over the profiles, as {function: (self-samples, total-samples)} """
+    self_samples = collections.Counter()
+    total_samples = collections.Counter()
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, count = line.rsplit(' ', 1)
+                stack = stack.split(';')
+                self_samples[stack[-1]] += int(count)
+                for func in set(stack):
+                    total_samples[func] += int(count)
+    return {func: (self_samples[func], total) for func, total in total_samples.items()}
@@ -0,0 +1,407 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import time
+import heapq
+import threading
+import traceback
+import collections
+import concurrent.futures
+import numpy as np
+
+from cloudsim import job
+from jointfunc_vcg import exp, results
+from jointfunc_vcg.exp import param
+
+"""
+Orders the jobs of a batch by their predicted runtime, longest first, to cut the batch's makespan.
+The runtimes are per dataset item: the wall time of a worker on one item (see `get_job_rounds()`).
+The runtime of each (experiment, join method, ndim) group is predicted from a complexity model
+(see `results.analyze.fit_complexity()`) that is fitted to prior results, and to the jobs that were
+already run by the scheduler.
+A job is a (func, args, kwargs) tuple, as in `job.add_batch_job()`.
+
+The scheduler can also admit the jobs by their estimated peak memory (see `estimate_job_memory()`), so small jobs
+run many-wide while large ones run alone.
+Jobs that are predicted to be shorter than a threshold can be coalesced into a single job (see `exp.coalesced()`)
+per dataset, so their dispatch and data loading do not dominate their runtime.
+"""
+
+DEFAULT_FIT_METHOD = 'complexity_pow'
+MIN_FIT_POINTS = 3
+# The profiled phases of the workers (see `profiling.PhaseProfiler`), which make up their runtime
+PROFILE_PHASES = 'shape', 'vals', 'auction', 'dtype-check', 'package'
+
+# The working set of the auction, in float64 gridpoints arrays, by join method (on top of the valuations)
+JOIN_METHOD_WORKING_SET = {
+    0: 2,  # The naive join only holds the joint valuation and its allocation
+}
+DEFAULT_WORKING_SET = 8
+# The memory of a worker process before it loads anything (python, numpy and the auction's library)
+BASE_JOB_MEMORY = 256 * 2 ** 20
+DEFAULT_MEMORY_MARGIN = 1.25
+
+
+def flatten(values):
+    """ Flattens the nested results of `read_unified_results()` """
+    if isinstance(values, (list, tuple, np.ndarray)):
+        for v in values:
+            yield from flatten(v)
+    else:
+        yield values
+
+
+def is_coalesced(kwargs):
+    return 'jobs' in kwargs
+
+
+def get_job_group(func, kwargs):
+    return func.__name__, kwargs.get('join_method', None), int(kwargs.get('ndim', 1))
+
+
+def get_job_gridpoints(kwargs):
+    return get_gridpoints(kwargs.get('sz', 2 ** 10), kwargs.get('ndim', 1))
+
+
+def get_job_rounds(args, kwargs):
+    """ Returns the number of consecutive rounds of items of a job: its items over the items it runs in parallel """
+    sim_kwargs = kwargs.get('sim_kwargs', None) or {}
+    parallel = max(int(sim_kwargs.get('max_workers', 1) or 1), 1)
+    return max(int(np.ceil(len(exp.get_job_items(args[0], sim_kwargs)) / parallel)), 1)
+
+
+def get_item_runtimes(r):
+    """ Returns the runtime of the worker on each item of the results: the sum of its profiled phases """
+    ret = None
+    for phase in PROFILE_PHASES:
+        try:
+            t = np.array(list(flatten(r['profile', phase, 'wall-time'])), dtype=float)
+        except (KeyError, TypeError):
+            continue
+        # Phases that some of the items skip (e.g., 'dtype-check') are missing from them
+        t = np.nan_to_num(t)
+        ret = t if ret is None else ret + t
+    return ret
+
+
+def iter_item_results(result):
+    """ Yields the workers' results (those with a profile) of each item in a finished job's result """
+    if isinstance(result, dict):
+        if isinstance(result.get('profile', None), dict):
+            yield result
+            return
+        # Keyed by item
+        result = list(result.values())
+    if isinstance(result, (list, tuple)):
+        for r in result:
+            yield from iter_item_results(r)
+
+
+def get_job_item_runtimes(result):
+    """
+    Returns the runtime of the worker on each item of a finished job's result: the sum of its profiled phases,
+    as for prior results (see `get_item_runtimes()`). Returns None if the result has no profile.
+    """
+    ret = [sum(r['profile'][phase].get('wall-time', 0.) for phase in PROFILE_PHASES if phase in r['profile'])
+           for r in iter_item_results(result)]
+    return ret or None
+
+
+def run_job(func, args, kwargs):
+    """
+    Runs a job (in a worker process of `RuntimeScheduler.run()`, or in a work queue's worker),
+    and waits for it if it is asynchronous, as cloudsim's batch does. Returns its result and its runtime.
+    """
+    start = time.time()
+    ret = func(*args, **kwargs)
+    # An asynchronous job returns a handle to join (strings also have a `join()`)
+    if hasattr(ret, 'join') and not isinstance(ret, (str, bytes)):
+        ret = ret.join()
+    return ret, time.time() - start
+
+
+def get_available_memory():
+    """ Returns the memory that is available for new jobs in bytes (Linux), or the total physical memory """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def get_gridpoints(sz, ndim):
+    return float(np.prod(param.get_shape_for_gridpoints(sz, ndim)))
+
+
+def estimate_vals_memory(n, sz, ndim, dtype=None, dtype_check_rate=0.):
+    """
+    Estimates the memory of the players' valuations in bytes.
+    Jobs that are re-run in float64 (see `workers.is_dtype_check_sampled()`) also hold a float64 copy.
+    """
+    itemsize = np.dtype(float if dtype is None else dtype).itemsize
+    if dtype_check_rate > 0 and itemsize < 8:
+        itemsize += 8
+    return get_gridpoints(sz, ndim) * n * itemsize
+
+
+def estimate_auction_memory(sz, ndim, join_methods=(None,)):
+    """ Estimates the working set of the auction in bytes, for its most demanding join method """
+    working_set = max(JOIN_METHOD_WORKING_SET.get(m, DEFAULT_WORKING_SET) for m in join_methods)
+    return get_gridpoints(sz, ndim) * working_set * 8
+
+
+def estimate_job_memory(func, args, kwargs, margin=DEFAULT_MEMORY_MARGIN):
+    """
+    Estimates the peak memory of a job in bytes.
+    Each of the dataset items that the job runs in parallel (its `sim_kwargs['max_workers']`) holds the players'
+    valuations (unless they are shared, see `shared_vals`) and the auction's working set.
+    """
+    if is_coalesced(kwargs):
+        return max(estimate_job_memory(func, args, dict(k, sim_kwargs=kwargs.get('sim_kwargs', None)), margin)
+                   for func, k in kwargs['jobs'])
+    sim_kwargs = kwargs.get('sim_kwargs', None) or {}
+    parallel = max(int(sim_kwargs.get('max_workers', 1) or 1), 1)
+    sz, ndim = kwargs.get('sz', 2 ** 10), kwargs.get('ndim', 1)
+    vals = estimate_vals_memory(args[0].meta['n'], sz, ndim, kwargs.get('dtype', None),
+                                kwargs.get('dtype_check_rate', 0.))
+    auction = estimate_auction_memory(sz, ndim, kwargs.get('join_methods', (kwargs.get('join_method', None),)))
+    if not kwargs.get('shared_vals', False):
+        vals *= parallel
+    return margin * (vals + (auction + BASE_JOB_MEMORY) * parallel)
+
+
+class RuntimeScheduler:
+    """
+    Predicts the runtime of the jobs, and orders them longest first.
+    If `dynamic` is set, `submit()` runs the jobs over `workers` processes, so each job has its own copy of its
+    dataset object: whenever a worker is free, it starts the longest remaining job, and each finished job's runtime
+    refines the predictions. A failed job does not stop the others: its result is its traceback, and it is
+    listed in `failed`.
+    Otherwise, `submit()` adds the jobs to the batch (`job.add_batch_job()`) in that order.
+    If `memory_budget` (in bytes, e.g., a part of `get_available_memory()`) is set, a job is only started while
+    the estimated memory of the running jobs (see `estimate_job_memory()`) fits the budget.
+    A job that does not fit the budget by itself runs alone. It requires `dynamic`.
+    If `coalesce_threshold` (in seconds per item) is set, the jobs that are predicted to be shorter are
+    coalesced (see `coalesce()`).
+    """
+    def __init__(self, workers=1, dynamic=False, fit_method=DEFAULT_FIT_METHOD, min_fit_points=MIN_FIT_POINTS,
+                 memory_budget=None, memory_margin=DEFAULT_MEMORY_MARGIN, coalesce_threshold=None):
+        if memory_budget is not None and not dynamic:
+            raise ValueError("A memory budget requires a dynamic scheduler.")
+        self.workers = workers
+        self.dynamic = dynamic
+        self.coalesce_threshold = coalesce_threshold
+        self.memory_budget = memory_budget
+        self.memory_margin = memory_margin
+        self.fit_method = fit_method
+        self.min_fit_points = min_fit_points
+        self.observations = collections.defaultdict(list)
+        self.models = {}
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def observe(self, group, gridpoints, runtime):
+        with self.lock:
+            self.observations[group].append((float(gridpoints), float(runtime)))
+            self.models.pop(group, None)
+
+    def load_results(self, ds_obj, exp_type, func, exp_prefix=None, exp_suffix=slice(None), runtime_key=None):
+        """
+        Adds the runtime of prior results of jobs of `func` (e.g., `exp.joint_val`) to the observations.
+        The runtime of each item is read from `runtime_key`, or else it is the sum of its profiled phases.
+        """
+        r = results.read_unified_results(ds_obj, exp_type, exp_prefix=exp_prefix, exp_suffix=exp_suffix)
+        ndim = list(flatten(r['input', 'ndim']))
+        gridpoints = list(flatten(r['input', 'gridpoints']))
+        if runtime_key is None:
+            runtime = get_item_runtimes(r)
+            if runtime is None:
+                raise ValueError("The results of %s have no profile. Set their runtime_key." % (exp_type,))
+        else:
+            runtime = list(flatten(r[runtime_key]))
+        try:
+            join_method = list(flatten(r['input', 'join-method']))
+        except (KeyError, TypeError):
+            join_method = [None] * len(ndim)
+        for d, g, t, m in zip(ndim, gridpoints, runtime, join_method):
+            if t is not None and np.isfinite(t):
+                self.observe((func.__name__, m, int(d)), g, t)
+
+    def get_model(self, group):
+        """ Returns the fitted parameters of the group's complexity model, or None if it cannot be fitted """
+        with self.lock:
+            if group in self.models:
+                return self.models[group]
+            obs = list(self.observations.get(group, ()))
+
+        popt = None
+        if len(set(g for g, _ in obs)) >= self.min_fit_points:
+            x, y = zip(*obs)
+            try:
+                popt, _, _ = results.analyze.fit_complexity(x, y, np.array(x), fit_method=self.fit_method)
+            except (RuntimeError, ValueError):
+                popt = None
+        with self.lock:
+            self.models[group] = popt
+        return popt
+
+    def predict(self, func, kwargs):
+        """
+        Predicts the runtime of a job from its group's model. If it cannot be fitted, the runtime is
+        extrapolated linearly in the gridpoints from the group's (or else the same ndim's, or else all the)
+        observations.
+        """
+        if is_coalesced(kwargs):
+            return sum(self.predict(f, k) for f, k in kwargs['jobs'])
+        group = get_job_group(func, kwargs)
+        gridpoints = get_job_gridpoints(kwargs)
+        popt = self.get_model(group)
+        if popt is not None:
+            func_model = getattr(results.analyze, self.fit_method)
+            return float(func_model(gridpoints, *popt))
+
+        with self.lock:
+            obs = list(self.observations.get(group, ()))
+            if not obs:
+                obs = [o for g, g_obs in self.observations.items() if g[2] == group[2] for o in g_obs]
+            if not obs:
+                obs = [o for g_obs in self.observations.values() for o in g_obs]
+        if not obs:
+            # No prior knowledge: larger and higher dimensional jobs are assumed to take longer
+            return gridpoints * group[2]
+        return gridpoints * np.mean([t / max(g, 1) for g, t in obs])
+
+    def plan(self, jobs):
+        """
+        Returns the jobs ordered longest first, their assignment to the workers (longest processing time first),
+        and the predicted makespan.
+        """
+        predicted = [self.predict(func, kwargs) for func, args, kwargs in jobs]
+        order = np.argsort(predicted, kind='stable')[::-1]
+        bins = [(0., i, []) for i in range(self.workers)]
+        for j in order:
+            load, i, assigned = heapq.heappop(bins)
+            assigned.append(jobs[j])
+            heapq.heappush(bins, (load + predicted[j], i, assigned))
+        bins.sort(key=lambda b: b[1])
+        return [jobs[j] for j in order], [b[2] for b in bins], max(b[0] for b in bins)
+
+    def observe_job(self, func, args, kwargs, result, runtime):
+        """
+        Adds the runtime of each item of a finished job to the observations: the sum of its profiled phases,
+        as for prior results (see `load_results()`). If its result has no profile, the job's runtime per round
+        of items is observed instead.
+        """
+        if is_coalesced(kwargs):
+            return
+        runtimes = get_job_item_runtimes(result)
+        if runtimes is None:
+            runtimes = [runtime / get_job_rounds(args, kwargs)]
+        for t in runtimes:
+            self.observe(get_job_group(func, kwargs), get_job_gridpoints(kwargs), t)
+
+    def estimate_memory(self, func, args, kwargs):
+        if self.memory_budget is None:
+            return 0.
+        return estimate_job_memory(func, args, kwargs, self.memory_margin)
+
+    def pop_next_job(self, pending, used_memory, is_idle):
+        """ Pops the longest predicted job that fits the memory budget, or returns None if none fits """
+        predicted = [self.predict(func, kwargs) for func, args, kwargs in pending]
+        for i in np.argsort(predicted, kind='stable')[::-1]:
+            memory = self.estimate_memory(*pending[i])
+            if self.memory_budget is None or used_memory + memory <= self.memory_budget or is_idle:
+                return pending.pop(int(i)), memory
+        return None
+
+    def run(self, jobs):
+        """
+        Runs the jobs in worker processes, always starting the longest predicted job that remains
+        (and fits the memory budget). Returns their results (a failed job's traceback), in their finishing order.
+        """
+        pending = list(jobs)
+        ret = []
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as ex:
+            running = {}
+            while pending or running:
+                while pending and len(running) < self.workers:
+                    nxt = self.pop_next_job(pending, sum(m for _, m in running.values()), not running)
+                    if nxt is None:
+                        break
+                    j, memory = nxt
+                    running[ex.submit(run_job, *j)] = j, memory
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    j, _ = running.pop(f)
+                    try:
+                        result, runtime = f.result()
+                    except Exception:
+                        self.failed.append((j, traceback.format_exc()))
+                        ret.append(self.failed[-1][1])
+                        continue
+                    self.observe_job(*j, result, runtime)
+                    ret.append(result)
+        return ret
+
+    def coalesce(self, jobs):
+        """
+        Coalesces the jobs that are predicted to be shorter than `coalesce_threshold` into a single job
+        (see `exp.coalesced()`) per dataset and job arguments (`sim_kwargs` and `index_path`).
+        Only the jobs whose group's model is fitted are coalesced: otherwise, their prediction is not in seconds.
+        """
+        ret = []
+        groups = collections.OrderedDict()
+        for func, args, kwargs in jobs:
+            if is_coalesced(kwargs) or self.get_model(get_job_group(func, kwargs)) is None or \
+                    self.predict(func, kwargs) >= self.coalesce_threshold:
+                ret.append((func, args, kwargs))
+                continue
+            sim_kwargs = kwargs.get('sim_kwargs', None)
+            index_path = kwargs.get('index_path', None)
+            key = id(args[0]), repr(sorted((sim_kwargs or {}).items())), index_path
+            groups.setdefault(key, (args, sim_kwargs, index_path, []))[3].append(
+                (func, {k: v for k, v in kwargs.items() if k not in ('sim_kwargs', 'index_path')}))
+
+        for args, sim_kwargs, index_path, group_jobs in groups.values():
+            if len(group_jobs) == 1:
+                func, kwargs = group_jobs[0]
+                ret.append((func, args, dict(kwargs, sim_kwargs=sim_kwargs, index_path=index_path)))
+            else:
+                ret.append((exp.coalesced, args, dict(jobs=group_jobs, sim_kwargs=sim_kwargs, index_path=index_path)))
+        return ret
+
+    def submit(self, jobs):
+        if self.coalesce_threshold is not None:
+            jobs = self.coalesce(jobs)
+        if self.dynamic:
+            return self.run(jobs)
+        ordered, _, _ = self.plan(jobs)
+        for func, args, kwargs in ordered:
+            job.add_batch_job(func, *args, **kwargs)
+
+
+def add_jobs(jobs, scheduler=None):
+    """ Adds the jobs to the batch in their order, or submits them to the scheduler """
+    if scheduler is not None:
+        return scheduler.submit(jobs)
+    for func, args, kwargs in jobs:
+        job.add_batch_job(func, *args, **kwargs)
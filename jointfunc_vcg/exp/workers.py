@@ -16,82 +16,178 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from jointfunc_vcg.data import produce
-from jointfunc_vcg.exp import param
+from jointfunc_vcg.data import produce, vals_cache, vals_shm
+from jointfunc_vcg.exp import param, payload, profiling
 import vecfunc_vcg
 from vecfunc_vcg.vecfuncvcglib import joint_func
 
 import numpy as np
 
 
+def get_vals(sd, shape, ndim, resource_dependency, vals_cache_dir=None, vals_shm_scope=None, dtype=None,
+             vals_tile_bytes=None):
+    """
+    Produces the valuations, or reads them from the on-disk cache if `vals_cache_dir` is set,
+    or shares them with the other jobs of the batch if `vals_shm_scope` is set.
+    If `vals_tile_bytes` is set, the valuations are produced tile by tile into the on-disk cache
+    (the default cache directory is used if `vals_cache_dir` is not set).
+    """
+    if vals_shm_scope is not None:
+        return vals_shm.get_vals(sd, shape, ndim, factor_wealth=True, resource_dependency=resource_dependency,
+                                 dtype=dtype, scope=vals_shm_scope)
+    if vals_cache_dir is None and vals_tile_bytes is None:
+        return produce.get_vals(sd, shape, ndim, factor_wealth=True, resource_dependency=resource_dependency,
+                                dtype=dtype)
+    return vals_cache.get_vals(sd, shape, ndim, factor_wealth=True, resource_dependency=resource_dependency,
+                               dtype=dtype, cache_dir=vals_cache_dir, tile_bytes=vals_tile_bytes)
+
+
+def get_dtype_name(dtype):
+    return np.dtype(float if dtype is None else dtype).name
+
+
+def is_dtype_check_sampled(index, dtype, dtype_check_rate):
+    """ Deterministically samples the jobs (by their dataset index) that are re-run in float64 """
+    if dtype_check_rate <= 0 or np.dtype(float if dtype is None else dtype) == np.float64:
+        return False
+    return np.random.RandomState(index).random_sample() < dtype_check_rate
+
+
+def get_dtype_divergence(ret, ret64):
+    """ Returns the max divergence of the auction's results from the results of the same auction in float64 """
+    eps = np.finfo(float).eps
+    divergence = {}
+    for k in ('allocations', 'sw', 'payments'):
+        if k not in ret or k not in ret64:
+            continue
+        a = np.asarray(ret[k], dtype=float)
+        b = np.asarray(ret64[k], dtype=float)
+        diff = np.abs(a - b)
+        divergence[k] = float(np.max(diff, initial=0))
+        divergence[k + '-relative'] = float(np.max(diff / np.maximum(np.abs(b), eps), initial=0))
+    return divergence
+
+
 #########################################################################################################
 # Maille Tuffin (1D Concave Comparison)
 #########################################################################################################
-def maille_tuffin(_ds_obj, index, sd, sz, ndim, resource_dependency):
-    shape = param.get_shape_for_gridpoints(sz, ndim)
-    gridpoints = np.prod(shape)
-    n_chunks = np.subtract(shape, 1)
-    val_slices, vals = produce.get_vals(sd, shape, ndim, factor_wealth=True, resource_dependency=resource_dependency)
-    ret = vecfunc_vcg.maille_tuffin(vals, val_slices, n_chunks)
-    return {
-        'input': {
-            'index': index,
-            'sz': sz,
-            'gridpoints': gridpoints,
-            'shape': shape,
-            'n-chunks': n_chunks,
-            'ndim': ndim,
-        },
-        **ret
-    }
+def maille_tuffin(_ds_obj, index, sd, sz, ndim, resource_dependency, vals_cache_dir=None,
+                  vals_shm_scope=None, dtype=None, dtype_check_rate=0., vals_tile_bytes=None, trace_malloc=False,
+                  result_detail=payload.DEFAULT_DETAIL):
+    prof = profiling.PhaseProfiler(trace_malloc)
+    with prof.phase('shape'):
+        shape = param.get_shape_for_gridpoints(sz, ndim)
+        gridpoints = np.prod(shape)
+        n_chunks = np.subtract(shape, 1)
+    with prof.phase('vals'):
+        val_slices, vals = get_vals(sd, shape, ndim, resource_dependency, vals_cache_dir, vals_shm_scope, dtype,
+                                    vals_tile_bytes)
+    with prof.phase('auction'):
+        ret = vecfunc_vcg.maille_tuffin(vals, val_slices, n_chunks)
+
+    if is_dtype_check_sampled(index, dtype, dtype_check_rate):
+        with prof.phase('dtype-check'):
+            del val_slices, vals
+            val_slices, vals = get_vals(sd, shape, ndim, resource_dependency)
+            ret['dtype-check'] = get_dtype_divergence(ret, vecfunc_vcg.maille_tuffin(vals, val_slices, n_chunks))
+
+    with prof.phase('package'):
+        ret = {
+            'input': {
+                'index': index,
+                'sz': sz,
+                'gridpoints': gridpoints,
+                'shape': shape,
+                'n-chunks': n_chunks,
+                'ndim': ndim,
+                'dtype': get_dtype_name(dtype),
+            },
+            **ret
+        }
+        ret = payload.compact_result(ret, result_detail)
+    ret['profile'] = prof.results()
+    return ret
 
 
 #########################################################################################################
 # Joint Valuation
 #########################################################################################################
-def joint_val(_ds_obj, index, sd, sz, ndim, join_method=3, join_chunk_size=8, join_flags=None,
-              resource_dependency='complementary'):
-    shape = param.get_shape_for_gridpoints(sz, ndim)
-    gridpoints = np.prod(shape)
-    n_chunks = np.subtract(shape, 1)
-    val_slices, vals = produce.get_vals(sd, shape, ndim, factor_wealth=True, resource_dependency=resource_dependency)
-    ret = vecfunc_vcg.joint_func(vals, n_chunks, join_method=join_method, join_chunk_size=join_chunk_size,
-                                 join_flags=join_flags)
-    return {
-        'input': {
-            'index': index,
-            'sz': sz,
-            'gridpoints': gridpoints,
-            'shape': shape,
-            'n-chunks': n_chunks,
-            'ndim': ndim,
-            'join-method': join_method,
-            'join-chunk-size': join_chunk_size,
-        },
-        **ret
-    }
+def joint_val(_ds_obj, index, sd, sz, ndim, join_method=3, join_chunk_size=param.DEFAULT_JOIN_CHUNK_SIZE,
+              join_flags=None, resource_dependency='complementary', vals_cache_dir=None, vals_shm_scope=None,
+              dtype=None, dtype_check_rate=0., vals_tile_bytes=None, trace_malloc=False,
+              result_detail=payload.DEFAULT_DETAIL):
+    prof = profiling.PhaseProfiler(trace_malloc)
+    with prof.phase('shape'):
+        shape = param.get_shape_for_gridpoints(sz, ndim)
+        gridpoints = np.prod(shape)
+        n_chunks = np.subtract(shape, 1)
+    with prof.phase('vals'):
+        val_slices, vals = get_vals(sd, shape, ndim, resource_dependency, vals_cache_dir, vals_shm_scope, dtype,
+                                    vals_tile_bytes)
+    with prof.phase('auction'):
+        ret = vecfunc_vcg.joint_func(vals, n_chunks, join_method=join_method, join_chunk_size=join_chunk_size,
+                                     join_flags=join_flags)
+
+    if is_dtype_check_sampled(index, dtype, dtype_check_rate):
+        with prof.phase('dtype-check'):
+            del val_slices, vals
+            val_slices, vals = get_vals(sd, shape, ndim, resource_dependency)
+            ret['dtype-check'] = get_dtype_divergence(ret, vecfunc_vcg.joint_func(
+                vals, n_chunks, join_method=join_method, join_chunk_size=join_chunk_size, join_flags=join_flags))
+
+    with prof.phase('package'):
+        ret = {
+            'input': {
+                'index': index,
+                'sz': sz,
+                'gridpoints': gridpoints,
+                'shape': shape,
+                'n-chunks': n_chunks,
+                'ndim': ndim,
+                'join-method': join_method,
+                'join-chunk-size': join_chunk_size,
+                'join-flags': join_flags,
+                'dtype': get_dtype_name(dtype),
+            },
+            **ret
+        }
+        ret = payload.compact_result(ret, result_detail)
+    ret['profile'] = prof.results()
+    return ret
 
 
 #########################################################################################################
 # Test data structure build time
 #########################################################################################################
 def test_joint_val_ds_build_time(_ds_obj, index, sd, sz, ndim, join_method=3, join_chunk_size=128,
-                                 resource_dependency='complementary'):
-    shape = param.get_shape_for_gridpoints(sz, ndim)
-    gridpoints = np.prod(shape)
-    n_chunks = np.subtract(shape, 1)
-    val_slices, vals = produce.get_vals(sd, shape, ndim, factor_wealth=True, resource_dependency=resource_dependency)
-    ret = joint_func.sum_test_ds_build_time(vals, method=join_method, chunk_size=join_chunk_size)
-    return {
-        'input': {
-            'index': index,
-            'sz': sz,
-            'gridpoints': gridpoints,
-            'shape': shape,
-            'n-chunks': n_chunks,
-            'ndim': ndim,
-            'join-method': join_method,
-            'join-chunk-size': join_chunk_size,
-        },
-        'stats': ret,
-    }
+                                 resource_dependency='complementary', vals_cache_dir=None, vals_shm_scope=None,
+                                 dtype=None, vals_tile_bytes=None, trace_malloc=False,
+                                 result_detail=payload.DEFAULT_DETAIL):
+    prof = profiling.PhaseProfiler(trace_malloc)
+    with prof.phase('shape'):
+        shape = param.get_shape_for_gridpoints(sz, ndim)
+        gridpoints = np.prod(shape)
+        n_chunks = np.subtract(shape, 1)
+    with prof.phase('vals'):
+        val_slices, vals = get_vals(sd, shape, ndim, resource_dependency, vals_cache_dir, vals_shm_scope, dtype,
+                                    vals_tile_bytes)
+    with prof.phase('auction'):
+        ret = joint_func.sum_test_ds_build_time(vals, method=join_method, chunk_size=join_chunk_size)
+    with prof.phase('package'):
+        ret = {
+            'input': {
+                'index': index,
+                'sz': sz,
+                'gridpoints': gridpoints,
+                'shape': shape,
+                'n-chunks': n_chunks,
+                'ndim': ndim,
+                'join-method': join_method,
+                'join-chunk-size': join_chunk_size,
+                'dtype': get_dtype_name(dtype),
+            },
+            'stats': ret,
+        }
+        ret = payload.compact_result(ret, result_detail)
+    ret['profile'] = prof.results()
+    return ret
@@ -0,0 +1,289 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import time
+import uuid
+import pickle
+import socket
+import tempfile
+import threading
+import traceback
+import multiprocessing
+import pandas as pd
+
+from jointfunc_vcg.exp import schedule
+
+"""
+A work queue of batch jobs in a directory, for running a sweep on several nodes.
+The coordinator publishes the jobs (the (func, args, kwargs) of `job.add_batch_job()`, e.g., `exp.joint_val()`
+on a dataset) to the queue, and worker daemons (`run_worker()`) on each node pull them and run them.
+The queue directory and the datasets must be on storage that is shared by the nodes: each job loads its dataset
+items and stores their results in the dataset, as it does on a single host. The job's return value is pushed
+back to the queue.
+
+The jobs move between the 'pending', 'running', 'done' and 'failed' sub-directories by atomic renames, so each
+job is claimed by one worker. A running job's worker touches its descriptor every `heartbeat_interval` seconds.
+A job whose heartbeat did not change for `lost_timeout` seconds (e.g., its node died) is re-queued, up to
+`max_attempts` times. The heartbeats are only compared with each other, and timed by the clock of the node that
+checks them, so the clocks of the nodes and of the file server need not agree.
+
+On a single machine, the same queue in a local directory, with `start_local_workers()`, is a stand-in for a cluster.
+"""
+
+STATES = 'pending', 'running', 'done', 'failed'
+DEFAULT_POLL_INTERVAL = 1.
+DEFAULT_HEARTBEAT_INTERVAL = 10.
+DEFAULT_LOST_TIMEOUT = 60.
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def get_worker_id():
+    return "%s-%d" % (socket.gethostname(), os.getpid())
+
+
+def write_atomic(path, obj):
+    fd, tmp_path = tempfile.mkstemp(prefix='tmp-', suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class WorkQueue:
+    """
+    A work queue in a (shared) directory.
+    It can be used as the `scheduler` of the `exp.batch` functions, to publish their jobs. If `scheduler` is given
+    (see `schedule.RuntimeScheduler`), the jobs are coalesced and ordered by it, longest first.
+    """
+    def __init__(self, queue_dir, scheduler=None, lost_timeout=DEFAULT_LOST_TIMEOUT,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.queue_dir = queue_dir
+        self.scheduler = scheduler
+        self.lost_timeout = lost_timeout
+        self.max_attempts = max_attempts
+        # The last heartbeat of each running job, and when it was first seen (by this node's clock)
+        self.heartbeats = {}
+        for state in STATES:
+            os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+    def get_path(self, state, job_id):
+        return os.path.join(self.queue_dir, state, job_id + '.pkl')
+
+    def list_jobs(self, state):
+        """ Returns the ids of the jobs in the state, in their queue order """
+        return sorted(f[:-4] for f in os.listdir(os.path.join(self.queue_dir, state))
+                      if f.endswith('.pkl') and not f.startswith('tmp-'))
+
+    def put(self, func, *args, **kwargs):
+        """ Publishes a job, and returns its id. The jobs are claimed in the order they were published. """
+        job_id = "%020d-%s" % (time.time_ns(), uuid.uuid4().hex[:8])
+        write_atomic(self.get_path('pending', job_id), {'job': (func, args, kwargs), 'attempts': 0})
+        return job_id
+
+    def submit(self, jobs):
+        """ Publishes the jobs, and returns their ids """
+        if self.scheduler is not None:
+            if self.scheduler.coalesce_threshold is not None:
+                jobs = self.scheduler.coalesce(jobs)
+            jobs, _, _ = self.scheduler.plan(jobs)
+        return [self.put(func, *args, **kwargs) for func, args, kwargs in jobs]
+
+    def claim(self, worker_id=None):
+        """ Claims the first pending job. Returns its id and its descriptor, or None if there is no pending job. """
+        for job_id in self.list_jobs('pending'):
+            path = self.get_path('running', job_id)
+            try:
+                os.rename(self.get_path('pending', job_id), path)
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
+            desc = read(path)
+            desc['worker'] = worker_id or get_worker_id()
+            desc['attempts'] += 1
+            write_atomic(path, desc)
+            return job_id, desc
+        return None
+
+    def get_heartbeat(self, job_id):
+        """ Returns a token of the running job's descriptor that changes whenever its worker touches it """
+        st = os.stat(self.get_path('running', job_id))
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def heartbeat(self, job_id):
+        """ Marks a running job as alive. Returns False if the job is no longer running (e.g., it was re-queued). """
+        try:
+            os.utime(self.get_path('running', job_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def finish(self, job_id, state, desc, **info):
+        desc.update(info, finished=time.time())
+        write_atomic(self.get_path(state, job_id), desc)
+        # A job that was re-queued while it ran is not run again
+        for s in ('running', 'pending'):
+            try:
+                os.remove(self.get_path(s, job_id))
+            except FileNotFoundError:
+                pass
+
+    def requeue_lost(self):
+        """
+        Re-queues the running jobs whose heartbeat did not change for `lost_timeout` seconds since this queue object
+        first saw it, or fails them after `max_attempts`. Returns the ids of the re-queued jobs.
+        """
+        ret = []
+        now = time.monotonic()
+        running = self.list_jobs('running')
+        self.heartbeats = {job_id: self.heartbeats[job_id] for job_id in running if job_id in self.heartbeats}
+        for job_id in running:
+            path = self.get_path('running', job_id)
+            try:
+                beat = self.get_heartbeat(job_id)
+            except FileNotFoundError:
+                continue
+            last_beat, since = self.heartbeats.get(job_id, (None, now))
+            if beat != last_beat:
+                self.heartbeats[job_id] = beat, now
+                continue
+            if now - since < self.lost_timeout:
+                continue
+            try:
+                desc = read(path)
+            except (FileNotFoundError, EOFError):
+                continue
+            del self.heartbeats[job_id]
+            if desc['attempts'] >= self.max_attempts:
+                self.finish(job_id, 'failed', desc, error="Lost %d times (last worker: %s)." %
+                                                          (desc['attempts'], desc.get('worker', None)))
+                continue
+            try:
+                # The next claim counts the attempt
+                os.rename(path, self.get_path('pending', job_id))
+            except FileNotFoundError:
+                # Finished, or re-queued by another node
+                continue
+            ret.append(job_id)
+        return ret
+
+    def get_result(self, job_id):
+        """ Returns the descriptor of a finished job (with its 'result' or 'error'), or None if it is not finished """
+        for state in ('done', 'failed'):
+            try:
+                return read(self.get_path(state, job_id))
+            except FileNotFoundError:
+                pass
+        return None
+
+    def wait(self, job_ids, poll_interval=DEFAULT_POLL_INTERVAL, timeout=None):
+        """ Waits for the jobs to finish (re-queueing lost jobs meanwhile), and returns their descriptors """
+        ret = {}
+        start = time.time()
+        while len(ret) < len(job_ids):
+            for job_id in job_ids:
+                if job_id not in ret:
+                    desc = self.get_result(job_id)
+                    if desc is not None:
+                        ret[job_id] = desc
+            if len(ret) == len(job_ids):
+                break
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError("%d of %d jobs did not finish." % (len(job_ids) - len(ret), len(job_ids)))
+            self.requeue_lost()
+            time.sleep(poll_interval)
+        return [ret[job_id] for job_id in job_ids]
+
+    def status(self):
+        """ Returns the state, worker and attempts of all the jobs """
+        rows = []
+        for state in STATES:
+            for job_id in self.list_jobs(state):
+                try:
+                    desc = read(self.get_path(state, job_id))
+                except (FileNotFoundError, EOFError):
+                    continue
+                rows.append((job_id, state, desc['job'][0].__name__, desc.get('worker', None), desc['attempts'],
+                             desc.get('runtime', None)))
+        return pd.DataFrame(rows, columns=['id', 'state', 'name', 'worker', 'attempts', 'runtime'])
+
+
+def keep_alive(queue, job_id, interval, stop_event):
+    while not stop_event.wait(interval):
+        if not queue.heartbeat(job_id):
+            break
+
+
+def run_worker(queue_dir, worker_id=None, poll_interval=DEFAULT_POLL_INTERVAL,
+               heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL, lost_timeout=DEFAULT_LOST_TIMEOUT,
+               max_attempts=DEFAULT_MAX_ATTEMPTS, max_jobs=None, idle_timeout=None):
+    """
+    A worker daemon: runs the queue's jobs one by one, until it ran `max_jobs` jobs or was idle for `idle_timeout`
+    seconds (default: forever). While idle, it re-queues the lost jobs.
+    Returns the number of jobs it ran.
+    """
+    queue = WorkQueue(queue_dir, lost_timeout=lost_timeout, max_attempts=max_attempts)
+    worker_id = worker_id or get_worker_id()
+    count = 0
+    idle_start = time.time()
+    while max_jobs is None or count < max_jobs:
+        claimed = queue.claim(worker_id)
+        if claimed is None:
+            if idle_timeout is not None and time.time() - idle_start > idle_timeout:
+                break
+            queue.requeue_lost()
+            time.sleep(poll_interval)
+            continue
+
+        job_id, desc = claimed
+        func, args, kwargs = desc['job']
+        stop_event = threading.Event()
+        threading.Thread(target=keep_alive, args=(queue, job_id, heartbeat_interval, stop_event), daemon=True).start()
+        start = time.time()
+        try:
+            result, runtime = schedule.run_job(func, args, kwargs)
+            queue.finish(job_id, 'done', desc, result=result, runtime=runtime)
+        except Exception:
+            desc.pop('result', None)
+            queue.finish(job_id, 'failed', desc, error=traceback.format_exc(), runtime=time.time() - start)
+        finally:
+            stop_event.set()
+        count += 1
+        idle_start = time.time()
+    return count
+
+
+def start_local_workers(queue_dir, workers=None, **kwargs):
+    """ Starts worker daemons (see `run_worker()`) in local processes. Returns the processes. """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    ret = []
+    for i in range(workers):
+        p = multiprocessing.Process(target=run_worker, args=(queue_dir,),
+                                    kwargs=dict(kwargs, worker_id="%s-local-%d" % (socket.gethostname(), i)))
+        p.start()
+        ret.append(p)
+    return ret
@@ -18,7 +18,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from cloudsim.dataset import DataSet
 from cloudsim.results import Results, UnifiedResults
-from jointfunc_vcg.exp import param
+from jointfunc_vcg.exp import param, completed
 from jointfunc_vcg.results import analyze, plot
 
 
@@ -33,7 +33,27 @@ def read_results(ds_obj: DataSet, exp_type, exp_param=None, exp_prefix=None, exp
 
 
 def read_unified_results(ds_obj: DataSet, exp_type,
-                         exp_param=slice(None), exp_prefix=None, exp_suffix=None, result_count=0):
-    """ Returns the raw unified results data """
+                         exp_param=slice(None), exp_prefix=None, exp_suffix=None, result_count=0, index_path=None):
+    """
+    Returns the raw unified results data.
+    If the index of completed experiments is used (see `completed.get_index_path()`), it is queried first, and
+    the results are only read if it has completed experiments under the key (or under keys that extend it).
+    Otherwise (e.g., for results that were produced before the index was used), the dataset's results are scanned.
+    """
     exp_key = param.get_experiment_name(exp_type, exp_param=exp_param, exp_prefix=exp_prefix, exp_suffix=exp_suffix)
+    index_path = completed.get_index_path(index_path)
+    if index_path is not None:
+        done = completed.query(ds_obj.meta['name'], exp_key, completed.STATUS_DONE, index_path, prefix=True)
+        if len(done) == 0:
+            print("No completed experiments match %s in the index. Scanning the results." % (exp_key,))
     return UnifiedResults(ds_obj, exp_key, result_count)
+
+
+def read_completed(ds_obj: DataSet, exp_type,
+                   exp_param=slice(None), exp_prefix=None, exp_suffix=slice(None), status=None, index_path=None):
+    """
+    Returns the completed experiments that match the key from the index (see `exp.completed`),
+    without reading the results
+    """
+    exp_key = param.get_experiment_name(exp_type, exp_param=exp_param, exp_prefix=exp_prefix, exp_suffix=exp_suffix)
+    return completed.query(ds_obj.meta['name'], exp_key, status, index_path)
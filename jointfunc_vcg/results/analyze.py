@@ -19,27 +19,71 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import numpy as np
 import pandas as pd
 from jointfunc_vcg import results
+from jointfunc_vcg.exp import param, payload, profiling
 from scipy.optimize import curve_fit
 
 
 def verify_joint_val_vs_maille_tuffin(ds_obj, exp_type, exp_prefix=None):
+    """ Requires the results' arrays, i.e., jobs that ran with `result_detail` of 'full' (default) or 'compressed' """
     r = results.read_unified_results(ds_obj, exp_type, exp_prefix=exp_prefix)
     print("Methods:", set([m for m_lst in r['joint-val', 'stats', 'method'] for m in m_lst]))
     print("Methods index:", set([m for m_lst in r['input', 'join-method'] for m in m_lst]))
 
-    a1 = r['maille-tuffin', 'allocations']
-    a2 = r['joint-val', 'allocations']
+    a1 = payload.decode_arrays(r['maille-tuffin', 'allocations'])
+    a2 = payload.decode_arrays(r['joint-val', 'allocations'])
     print("Matching allocations:", np.all(np.squeeze(a1) == np.squeeze(a2)))
 
     sw1 = r['maille-tuffin', 'sw']
     sw2 = r['joint-val', 'sw']
     print("Matching SW:", np.all(np.isclose(sw1, sw2)))
 
-    p1 = r['maille-tuffin', 'payments']
-    p2 = r['joint-val', 'payments']
+    p1 = payload.decode_arrays(r['maille-tuffin', 'payments'])
+    p2 = payload.decode_arrays(r['joint-val', 'payments'])
     print("Matching payments:", np.all(np.isclose(p1, p2)))
 
 
+def dtype_divergence(ds_obj, exp_type, exp_prefix=None, exp_suffix=None):
+    """ Reports the max divergence of the reduced precision jobs that were re-run in float64 """
+    r = results.read_unified_results(ds_obj, exp_type, exp_prefix=exp_prefix, exp_suffix=exp_suffix)
+    ret = {}
+    for k in ('allocations', 'sw', 'payments'):
+        for name in (k, k + '-relative'):
+            try:
+                v = np.array(r['dtype-check', name], dtype=float).flatten()
+            except (KeyError, TypeError, ValueError):
+                continue
+            v = v[~np.isnan(v)]
+            if len(v) > 0:
+                ret[name] = v.max()
+                print("Max %s divergence: %g (%d checked jobs)" % (name, v.max(), len(v)))
+    return ret
+
+
+def profile_hot_functions(ds_obj, exp_type, exp_param=slice(None), exp_prefix=None, exp_suffix=None,
+                          profile='cprofile', top=20, profiles_dir=None):
+    """
+    Aggregates the profiles of all the jobs of a sweep (see the `profile` option of `exp.start()`)
+    into a table of the `top` hot functions, sorted by their self time (or self samples).
+    """
+    exp_key = param.get_experiment_name(exp_type, exp_param=exp_param, exp_prefix=exp_prefix, exp_suffix=exp_suffix)
+    paths = profiling.find_profiles(ds_obj.meta['name'], exp_key, profiles_dir)[profile]
+    print("Profiled jobs:", len(paths))
+    if len(paths) == 0:
+        return None
+
+    if profile == 'cprofile':
+        stats = profiling.load_cprofile_stats(paths)
+        columns = ['Calls', 'Self Time', 'Total Time']
+    else:
+        stats = profiling.load_sampling_stats(paths)
+        columns = ['Self Samples', 'Total Samples']
+
+    df = pd.DataFrame([(f, *v) for f, v in stats.items()], columns=['Function', *columns])
+    df['Self Fraction'] = df[columns[-2]] / df[columns[-2]].sum()
+    df[columns[-2] + ' Per Job'] = df[columns[-2]] / len(paths)
+    return df.sort_values(columns[-2], ascending=False).head(top).reset_index(drop=True)
+
+
 def joint_val_data_frame(ds_obj, exp_type, exp_prefix=None, exp_suffix=None, fields=()):
     r = results.read_unified_results(ds_obj, exp_type, exp_prefix=exp_prefix, exp_suffix=exp_suffix)
 
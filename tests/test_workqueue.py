@@ -0,0 +1,125 @@
+"""
+Author: Liran Funaro <liran.funaro@gmail.com>
+
+Copyright (C) 2006-2018 Liran Funaro
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+
+from jointfunc_vcg.exp import workqueue
+
+"""
+Tests the work queue with its local stand-in for a cluster (`workqueue.start_local_workers()`).
+"""
+
+FAST = dict(poll_interval=0.05, heartbeat_interval=0.1, lost_timeout=1.)
+
+
+def square(x):
+    return x * x
+
+
+def hang_once(marker_path):
+    """ Hangs on its first attempt (until its worker is killed), and succeeds on the next one """
+    if not os.path.exists(marker_path):
+        open(marker_path, 'w').close()
+        time.sleep(600)
+    return 'recovered'
+
+
+def wait_for_state(queue, job_id, state, timeout=10.):
+    start = time.time()
+    while job_id not in queue.list_jobs(state):
+        if time.time() - start > timeout:
+            raise TimeoutError("Job %s did not reach '%s'." % (job_id, state))
+        time.sleep(0.05)
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp(prefix='test-workqueue-')
+        self.processes = []
+
+    def tearDown(self):
+        for p in self.processes:
+            if p.is_alive():
+                p.kill()
+            p.join()
+        shutil.rmtree(self.queue_dir, ignore_errors=True)
+
+    def start_workers(self, workers, **kwargs):
+        self.processes.extend(workqueue.start_local_workers(self.queue_dir, workers, **dict(FAST, **kwargs)))
+
+    def test_local_workers(self):
+        queue = workqueue.WorkQueue(self.queue_dir, lost_timeout=FAST['lost_timeout'])
+        job_ids = [queue.put(square, i) for i in range(8)]
+        self.start_workers(2, idle_timeout=1.)
+        descs = queue.wait(job_ids, poll_interval=0.05, timeout=30)
+        self.assertEqual([d['result'] for d in descs], [i * i for i in range(8)])
+        self.assertTrue(all(d['attempts'] == 1 for d in descs))
+        self.assertEqual(queue.list_jobs('pending') + queue.list_jobs('running'), [])
+
+    def test_killed_worker_is_requeued(self):
+        queue = workqueue.WorkQueue(self.queue_dir, lost_timeout=FAST['lost_timeout'])
+        job_id = queue.put(hang_once, os.path.join(self.queue_dir, 'marker'))
+        self.start_workers(1)
+        wait_for_state(queue, job_id, 'running')
+        os.kill(self.processes[0].pid, signal.SIGKILL)
+        self.processes[0].join()
+
+        self.start_workers(1, idle_timeout=5.)
+        desc, = queue.wait([job_id], poll_interval=0.05, timeout=30)
+        self.assertEqual(desc['result'], 'recovered')
+        self.assertEqual(desc['attempts'], 2)
+
+    def test_lost_job_fails_after_max_attempts(self):
+        queue = workqueue.WorkQueue(self.queue_dir, lost_timeout=0., max_attempts=1)
+        job_id = queue.put(square, 3)
+        queue.claim('dead-worker')
+        # The first check only sees the heartbeat; the job is lost once it did not change
+        self.assertEqual(queue.requeue_lost(), [])
+        self.assertEqual(queue.requeue_lost(), [])
+        desc = queue.get_result(job_id)
+        self.assertIn('Lost 1 times', desc['error'])
+        self.assertEqual(queue.list_jobs('running'), [])
+
+    def test_requeue_ignores_skewed_clocks(self):
+        queue = workqueue.WorkQueue(self.queue_dir, lost_timeout=60.)
+        job_id = queue.put(square, 3)
+        queue.claim('skewed-worker')
+        # A heartbeat that is stamped far in the past (e.g., by a file server with a skewed clock)
+        os.utime(queue.get_path('running', job_id), (0, 0))
+        self.assertEqual(queue.requeue_lost(), [])
+        self.assertEqual(queue.list_jobs('running'), [job_id])
+
+    def test_requeue_is_a_single_rename(self):
+        queue = workqueue.WorkQueue(self.queue_dir, lost_timeout=0.)
+        job_id = queue.put(square, 3)
+        queue.claim('dead-worker')
+        queue.requeue_lost()
+        self.assertEqual(queue.requeue_lost(), [job_id])
+        self.assertEqual(queue.list_jobs('running'), [])
+        self.assertEqual(queue.list_jobs('pending'), [job_id])
+        claimed_id, desc = queue.claim('new-worker')
+        self.assertEqual((claimed_id, desc['attempts'], desc['worker']), (job_id, 2, 'new-worker'))
+
+
+if __name__ == '__main__':
+    unittest.main()